@@ -9,8 +9,24 @@ from redpitaya.overlay.mercury import mercury as overlay
 import socket, selectors, traceback, libserver
 import numpy as np
 from time import perf_counter, sleep
-from peak_finders import SG_array, peak_finders
+
+try:
+    from time import perf_counter_ns
+except ImportError:  # python < 3.7
+
+    def perf_counter_ns():
+        return int(perf_counter() * 1e9)
+
+from peak_finders import SG_array, peak_finders, minmax_indices, BatchPeakFinder, find_peaks
 from copy import deepcopy
+from collections import namedtuple
+from functools import partial
+
+# compiled settings of one laser, see RP_Lock.compile_plan. row is the first
+# row of its peaks in RP_Lock.peaks, gen the output (None if there is none).
+LaserPlan = namedtuple(
+    "LaserPlan", ["key", "master", "ranges", "finder", "row", "sign", "pid", "gen"]
+)
 
 
 class Receiver:
@@ -19,6 +35,10 @@ class Receiver:
         self.addr = addr
         self.action_dict = action_dict
         self.iteration = None
+        # during a loop, the sockets are only polled every poll_every iterations
+        # or once poll_interval (s) has passed since the last poll
+        self.poll_every = 10
+        self.poll_interval = 2e-3
 
     def accept_wrapper(self, sock, stop=True):
         """
@@ -76,17 +96,27 @@ class Receiver:
 
     def start_server(self):
         # start the actual event loop!
+        iterations = 0  # since the last poll
+        t_poll = perf_counter()
         try:
             while self.server_running:
-                # print('hi')
-                sleep(1e-4)
                 # if defined, run the iteration!
                 if self.iteration != None:
                     self.iteration()
+                    iterations += 1
                 if self.loop:
-                    events = self.sel.select(
-                        timeout=1e-4
-                    )  # check the handled socket connections
+                    if self.iteration != None:
+                        if (
+                            iterations < self.poll_every
+                            and perf_counter() - t_poll < self.poll_interval
+                        ):
+                            continue  # do not delay the next iteration
+                        iterations = 0
+                        t_poll = perf_counter()
+                        timeout = 0  # check the handled socket connections without waiting
+                    else:
+                        timeout = self.poll_interval  # nothing else to do
+                    events = self.sel.select(timeout=timeout)
                 else:
                     events = self.sel.select(timeout=None)
                 for key, mask in events:
@@ -160,8 +190,10 @@ class RP_Server(Receiver):  # handles socket communication from redpitaya side
             "count": self.action_count,
             "close": self.action_close,
             "acquire_ch_n": self.action_acquire_ch_n,
+            "acquire_ch_stream": self.action_acquire_ch_stream,
             "monitor": self.action_monitor,
             "acquire_peaks_ch": self.action_acquire_peaks_ch,
+            "find_peaks": self.action_find_peaks,
             "update_settings": self.action_update_settings,
             "start_lock": self.action_start_lock,
             "start_lock2": self.action_start_lock,
@@ -172,6 +204,11 @@ class RP_Server(Receiver):  # handles socket communication from redpitaya side
             "set_dec": self.action_set_dec,
             "acquire_errs": self.action_acquire_errs,
             "set_peakfinder": self.action_set_peakfinder,
+            "acquire_stats": self.action_acquire_stats,
+            "acquire_roi": self.action_acquire_roi,
+            "latency": self.lock.get_latency,
+            "pipeline": self.lock.set_pipeline,
+            "tracking": self.lock.set_tracking,
         }
 
     def action_set(self, query):
@@ -197,8 +234,8 @@ class RP_Server(Receiver):  # handles socket communication from redpitaya side
         return times
 
     def action_update_settings(self, query):
-        self.lock.update_settings(query)
-        return "Lock settings updated!"
+        # the error message of rejected settings (see RP_Lock.check_settings) is passed on
+        return self.lock.update_settings(query)
 
     def action_start_lock(self, query):
         if self.RP_mode in ["scan", "lock"]:
@@ -242,7 +279,7 @@ class RP_Server(Receiver):  # handles socket communication from redpitaya side
         print("Hi!")
         self.lock.acquire()
         data = self.lock.acquisition
-        return data.tolist()
+        return data
 
     def action_acquire_ch(self, query):  # this is used to monitor the cavity signal
         ch = int(query)
@@ -250,7 +287,22 @@ class RP_Server(Receiver):  # handles socket communication from redpitaya side
         duration = self.lock.times[
             -1
         ]  # instead of the full time trace, just give the last time value! the first one is always 0 and the number of data points is always the same
-        return [duration, data.tolist()]
+        return [duration, data]
+
+    def action_acquire_roi(self, query):
+        # query is a dictionary, e.g. dict(ch=0, ranges=[[2000, 4000]], step=1).
+        # Only the data inside the index ranges (regions of interest) is returned,
+        # for display purposes only every step-th point. If 'bins' is given, each
+        # of these windows is further decimated with minmax_indices and returned as
+        # [indices, values], the indices counting the points of the window.
+        data = self.lock.acquire_ch(int(query["ch"]))
+        duration = self.lock.times[-1]
+        step = int(query.get("step", 1))
+        windows = [data[r[0] : r[-1] : step] for r in query["ranges"]]
+        if query.get("bins"):
+            j_list = [minmax_indices(w, int(query["bins"])) for w in windows]
+            windows = [[j, w[j]] for j, w in zip(j_list, windows)]
+        return [duration, windows]
 
     def action_acquire_ch_n(self, query):
         dat_list = []
@@ -268,7 +320,18 @@ class RP_Server(Receiver):  # handles socket communication from redpitaya side
         print(perf_counter() - t0)
         dat_arr = np.stack(dat_list, axis=0)
         # return dat_list
-        return dat_arr.tolist()
+        return dat_arr
+
+    def action_acquire_ch_stream(self, query):
+        # same syntax as acquire_ch_n, but without limit: the traces are not
+        # stored, each one is sent by the server as soon as it is acquired.
+        ch, n = int(query[0]), int(query[2:])
+        return (self.lock.acquire_ch(ch) for i in range(n))
+
+    def action_acquire_stats(self, query):
+        # query is a dictionary with the arguments of RP.acquire_stats, e.g.
+        # dict(ch=0, n=10000, ranges=[[2000, 4000]], bins=100)
+        return self.lock.acquire_stats(**query)
 
     def action_acquire_peaks_ch(self, query):
         # acquire the peak on a certain channel --> range must be given in query!
@@ -281,24 +344,31 @@ class RP_Server(Receiver):  # handles socket communication from redpitaya side
         for R in query_list[1:]:  # iterate through each range string
             R1, R2 = R.split(",")
             try:
-                P, FWHM = self.lock.acquire_peaks(
-                    [int(R1), int(R2)]
+                P = peak_finders["maximum"](
+                    self.lock.times, acq, [int(R1), int(R2)]
                 )  # retrieve the peak
                 peaks.append(P[0])
             except:
                 peaks.append(None)
         return peaks  # return the list of peaks!
 
+    def action_find_peaks(self, query):
+        # query is a dictionary, e.g. dict(ch=0, prominence=0.05, distance=10).
+        # All peaks of one trace are returned as an array of [position (ms), height, width (ms)].
+        return self.lock.find_peaks(**query)
+
     def action_acquire_errs(self, query):
         if self.lock.FSR_ref == None:
             self.lock.init_FSR_ref()  # first, save the FSR for proper error calculation!
-        self.lock.update_pos()
+        self.lock.update_pos(widths=True)
         if self.lock.skipped:
             return "skipped"
         else:
             for key in self.lock.settings:
                 self.lock.update_err(key)
-            return self.lock.errs
+            errs = dict(self.lock.errs)
+            errs["widths"] = self.lock.get_widths()  # measured in this trace
+            return errs
 
     def action_set_peakfinder(self, query):
         # query is a dictionary
@@ -368,11 +438,162 @@ class RP_Server(Receiver):  # handles socket communication from redpitaya side
         if len(dat_list) > 0:
             dat_arr = np.stack(dat_list, axis=0)
             print(dat_arr.shape)
-            return dat_arr.tolist()
+            return dat_arr
         else:
             return "Done"  # self.lock.acquisition.tolist()
 
 
+class LatencyRing:
+    """
+    Fixed size ring buffer of perf_counter_ns stamps taken at the end of each
+    phase of a lock iteration. Each row holds the stamps of one iteration,
+    the first column being its start. Only completed iterations are committed.
+    """
+
+    def __init__(self, phases, size=4096):
+        self.phases = phases
+        self.size = size
+        self.stamps = np.zeros((size, len(phases) + 1), dtype=np.int64)
+        self.row = 0  # row of the current iteration
+        self.count = 0  # number of committed iterations
+
+    def stamp(self, k):
+        self.stamps[self.row, k] = perf_counter_ns()
+
+    def commit(self):
+        self.row = (self.row + 1) % self.size
+        self.count += 1
+
+    def reset(self):
+        self.row = 0
+        self.count = 0
+
+    def summary(self):
+        # percentiles of the duration of each phase (and the total) in us
+        if self.count < self.size:
+            rows = self.stamps[: self.count]
+        else:  # the current row might contain stamps of an unfinished iteration
+            rows = np.delete(self.stamps, self.row, axis=0)
+        if len(rows) == 0:
+            return {}
+        durations = np.diff(rows, axis=1) * 1e-3
+        total = (rows[:, -1] - rows[:, 0]) * 1e-3
+        result = {}
+        for phase, d in zip(self.phases + ("total",), list(durations.T) + [total]):
+            p50, p99 = np.percentile(d, [50, 99])
+            result[phase] = dict(p50=float(p50), p99=float(p99), max=float(d.max()))
+        result["n"] = len(rows)
+        return result
+
+
+class LoopTelemetry:
+    """
+    Counters of the lock loop since the last poll: iterations, skipped points
+    and the intervals between iterations. Their mean and standard deviation
+    are accumulated with Welford's algorithm, the recent ones are kept in a
+    ring buffer for percentiles, and a log2 histogram shows rare outliers.
+    Cheap enough to be updated on every iteration.
+    """
+
+    def __init__(self, size=4096):
+        self.t_prev = None
+        self.ring = np.zeros(size, dtype=np.int64)  # recent intervals in ns
+        self.reset()
+
+    def reset(self):
+        self.t_start = perf_counter_ns()
+        self.iterations = 0
+        self.skipped = 0
+        self.hist = [0] * 64  # bin k: 2**(k-1) <= interval < 2**k ns
+        self.n = 0  # number of intervals
+        self.mean = 0.0
+        self.M2 = 0.0  # sum of squared deviations
+
+    def tick(self, skipped):
+        now = perf_counter_ns()
+        if self.t_prev is not None:
+            dt = now - self.t_prev
+            self.hist[dt.bit_length()] += 1
+            self.ring[self.n % len(self.ring)] = dt
+            self.n += 1
+            delta = dt - self.mean
+            self.mean += delta / self.n
+            self.M2 += delta * (dt - self.mean)
+        self.t_prev = now
+        self.iterations += 1
+        self.skipped += skipped
+
+    def poll(self):
+        # returns the telemetry since the last poll and starts over
+        elapsed = (perf_counter_ns() - self.t_start) * 1e-9
+        intervals = [
+            [2 ** (k - 1) * 1e-3, 2**k * 1e-3, count]  # bin edges in us
+            for k, count in enumerate(self.hist)
+            if count
+        ]
+        result = dict(
+            rate=self.iterations / elapsed,
+            iterations=self.iterations,
+            skipped=self.skipped,
+            intervals=intervals,
+            interval=self.interval_stats(),
+        )
+        self.reset()
+        return result
+
+    def interval_stats(self):
+        # mean, standard deviation and percentiles (p50/p99 of the recent
+        # intervals, up to the size of the ring) of the intervals in us
+        if not self.n:
+            return {}
+        recent = self.ring[: min(self.n, len(self.ring))] * 1e-3
+        p50, p99 = np.percentile(recent, [50, 99])
+        std = (self.M2 / (self.n - 1)) ** 0.5 if self.n > 1 else 0.0
+        return dict(
+            mean=self.mean * 1e-3,
+            std=std * 1e-3,
+            p50=float(p50),
+            p99=float(p99),
+            max=float(recent.max()),
+            n=self.n,
+        )
+
+
+class TraceStats:
+    """
+    Accumulates statistics of consecutive traces: mean and variance (Welford's
+    algorithm) as well as the min/max envelope. All of it is done in place in
+    preallocated float32 buffers, so only the result has to be transferred.
+    """
+
+    def __init__(self, N):
+        self.n = 0
+        self.mean = np.zeros(N, dtype=np.float32)
+        self.M2 = np.zeros(N, dtype=np.float32)  # sum of squared deviations
+        self.min = np.full(N, np.inf, dtype=np.float32)
+        self.max = np.full(N, -np.inf, dtype=np.float32)
+        self._delta = np.empty(N, dtype=np.float32)
+        self._tmp = np.empty(N, dtype=np.float32)
+
+    def update(self, dat):
+        self.n += 1
+        np.subtract(dat, self.mean, out=self._delta)
+        np.divide(self._delta, self.n, out=self._tmp)
+        self.mean += self._tmp
+        np.subtract(dat, self.mean, out=self._tmp)
+        self._tmp *= self._delta
+        self.M2 += self._tmp
+        np.minimum(self.min, dat, out=self.min)
+        np.maximum(self.max, dat, out=self.max)
+
+    def result(self):
+        if self.n > 1:
+            var = self.M2 / (self.n - 1)
+        else:
+            var = np.zeros_like(self.M2)
+        return dict(n=self.n, mean=self.mean, var=var, min=self.min, max=self.max)
+
+
 class PID:
     def __init__(self, P=0, I=0, D=0, I_val=0, limit=[-1, 1]):
         self.P = P
@@ -384,15 +605,18 @@ class PID:
         self.MV = self.start
         self.limit = limit
         self.on = True
+        self.saturated = 0  # number of updates at the limit, see RP_Lock.get_telemetry
 
     def check_limit(self):
         max_lim = max(self.limit)
         min_lim = min(self.limit)
         if self.MV >= max_lim:
             self.MV = max_lim
+            self.saturated += 1
             print("PID reached limit {}!".format(max_lim))
         elif self.MV <= min_lim:
             self.MV = min_lim
+            self.saturated += 1
             print("PID reached limit {}!".format(min_lim))
 
     def update(self, e, t):
@@ -441,6 +665,7 @@ class RP:  # handles the functionality of the redpitaya
         square = self.gen_trig.square()
 
         self.N = N_osc
+        self.dec = dec
         dur = self.duration(dec)  # duration in seconds
         self.times = np.linspace(0, dur - (8e-9 * dec), self.N) * 1e3  # in ms
 
@@ -517,10 +742,23 @@ class RP:  # handles the functionality of the redpitaya
             self.gen_trig.start_trigger()
             self.gen_ramp.start_trigger()
         self.trigger_armed = False
+        self.scan_started = False  # whether the ramp of the next scan already runs
+        self.t_armed = perf_counter()  # time at which the oscilloscope was (re)armed
+        # after the expected end of a scan, status_run is polled continuously
+        # for trigger_poll_busy (s), afterwards with sleeps of trigger_poll_sleep (s)
+        self.trigger_poll_busy = 1e-3
+        self.trigger_poll_sleep = 1e-4
 
     def duration(self, dec):
         return 8e-9 * self.N * dec  # duration in seconds
 
+    def ms2index(self, ms):
+        # (fractional) trace index of a time in ms for the current dec, works on arrays
+        return np.asarray(ms, dtype=float) * (self.N / (self.duration(self.dec) * 1e3))
+
+    def index2ms(self, i):
+        return np.asarray(i, dtype=float) * (self.duration(self.dec) * 1e3 / self.N)
+
     def set_dec(self, dec):
         kwargs = dict(
             burst_data_repetitions=int(
@@ -536,6 +774,7 @@ class RP:  # handles the functionality of the redpitaya
         # set oscilloscope decimation
         for ch in range(2):
             self.set_osc_ch(ch, decimation=dec)
+        self.dec = dec
         dur = self.duration(dec)
         self.times = np.linspace(0, dur - (8e-9 * dec), self.N) * 1e3
 
@@ -550,12 +789,27 @@ class RP:  # handles the functionality of the redpitaya
         if not self.trigger_armed:
             self.osc[1].reset()
             self.osc[1].start()
+            self.t_armed = perf_counter()
         if self.mode == "scan":
-            self.gen_ramp.reset()
-            self.gen_ramp.start_trigger()
-
+            if not self.scan_started:
+                self.start_scan()
+            self.scan_started = False  # this scan is used up by the acquisition
+        # the trace is complete one scan duration after arming at the earliest,
+        # so there is no need to poll before. Sleeping frees the CPU.
+        remaining = self.duration(self.dec) - (perf_counter() - self.t_armed)
+        if remaining > 2e-4:  # leave some margin for the inaccuracy of sleep
+            sleep(remaining - 1e-4)
+        t_poll = perf_counter()
         while self.osc[1].status_run():
-            pass
+            if perf_counter() - t_poll > self.trigger_poll_busy:
+                sleep(self.trigger_poll_sleep)  # e.g. waiting for an external trigger
+
+    def start_scan(self):
+        # start a single ramp of the cavity scan (scan mode)
+        self.gen_ramp.reset()
+        self.gen_ramp.start_trigger()
+        self.t_armed = perf_counter()  # the scan starts now
+        self.scan_started = True
 
     ##################### acquisition functions ###############################
 
@@ -563,24 +817,71 @@ class RP:  # handles the functionality of the redpitaya
         self.trigger()
         ch1 = self.osc[0].data(self.N)
         ch2 = self.osc[1].data(self.N)
-        self.osc[1].reset()
-        self.osc[1].start()
-        # if self.times[-1] > 60: # if decimation roughly >= 2**9
-        #    sleep(self.times[-1]*1e-3 * 1.2)
-        self.trigger_armed = True
+        self.rearm()
         self.acquisition = np.array([self.times, ch1, ch2])
         return self.acquisition
 
     def acquire_ch(self, ch):
         self.trigger()
+        return self.read_ch(ch)
+
+    def read_ch(self, ch):
+        # read the triggered trace of channel ch and rearm the oscilloscope
         dat = self.osc[ch].data(int(self.N))
+        self.rearm()
+        return dat
+
+    def read_ch_windows(self, ch, windows, out):
+        """
+        read only the index windows [i0, i1) of the triggered trace of channel
+        ch into the full length array out and rearm the oscilloscope. The
+        samples outside of the windows are not touched.
+        """
+        # the trace ends at the write pointer of the circular buffer (buffer_size = N)
+        ptr = int(self.osc[ch].pointer)
+        for i0, i1 in windows:
+            out[i0:i1] = self.osc[ch].data(i1 - i0, (ptr + i1) % self.N)
+        self.rearm()
+        return out
+
+    def rearm(self):
         self.osc[1].reset()
         self.osc[1].start()
+        self.t_armed = perf_counter()
         # if self.times[-1] > 60: # if decimation roughly >= 2**9
         #    sleep(self.times[-1]*1e-3 * 1.2)
         self.trigger_armed = True
-        # self.acquisition = np.array([self.times, dat])
-        return dat
+
+    def acquire_stats(self, ch, n, ranges=[], bins=100, peak_finder="maximum"):
+        """
+        Acquire n traces on channel ch and only keep their statistics (see
+        TraceStats). For each index range in ranges, a histogram of the peak
+        positions found by peak_finder is added.
+        """
+        stats = TraceStats(self.N)
+        finder = peak_finders[peak_finder]
+        positions = np.empty((len(ranges), n))
+        for i in range(n):
+            dat = self.acquire_ch(ch)
+            stats.update(dat)
+            for j, r in enumerate(ranges):
+                positions[j, i] = finder(self.times, dat, r)[0]
+        result = stats.result()
+        result["peaks"] = []
+        for j, r in enumerate(ranges):
+            counts, edges = np.histogram(
+                positions[j], bins=bins, range=(self.times[r[0]], self.times[r[-1] - 1])
+            )
+            result["peaks"].append(dict(range=r, counts=counts, edges=edges))
+        return result
+
+    def find_peaks(self, ch, prominence, distance=1):
+        """
+        Acquires a trace on channel ch and finds all peaks with at least the
+        given prominence (see peak_finders.find_peaks), e.g. to calibrate the
+        frequency axis with all modes of the cavity at once.
+        """
+        return find_peaks(self.times, self.acquire_ch(ch), prominence, distance)
 
     def close(self):
         for ch in range(2):
@@ -618,8 +919,56 @@ class RP_Lock(RP, reaction_loop):
         # peak_finding stuff
         self.skipped = False
         self.invert = False
+        # only the union of the ranges (windows) is read into the trace buffer,
+        # see update_windows. If None, the whole trace is read.
+        self.windows = None
+        self.trace = np.zeros(self.N)
+        # settings compiled for the locking steps, see compile_plan
+        self.plan = ()
+        self.peaks = np.zeros((0, 2))  # position and height for each range
+        self.data = dict()
+        self.peak_finder = BatchPeakFinder((), ())
+        # index space representation of the plan (same order), see compile_plan:
+        # the lockpoint of each laser and the range it has to lie in
+        self.lockpoints = np.zeros(0)
+        self.bounds = np.zeros((0, 2), dtype=int)
+        # In scan mode, the next scan is started right after the readout, such that
+        # it is captured while the current one is processed (see acquire_cav_signal).
+        # Off by default: it delays the feedback by one scan, which changes the
+        # dynamics of the loop for PID gains tuned without it.
+        self.pipeline = False
+        self.pipelining = False  # only True while the lock loop runs
+        self.pending_offset = None  # Master offset, applied when the next scan starts
+        self.action_dict["pipeline"] = self.set_pipeline
+        # While locking, the peaks can be searched only near their last positions,
+        # see BatchPeakFinder.track. half width of the search windows in samples.
+        # Off (0) by default, as it changes how the peaks are found, see set_tracking
+        self.tracking = 0
+        self.track_threshold = 0.5  # search the whole range below this fraction of the height
+        self.tracked = False  # True during the lock, when the peaks can be tracked
+        self.action_dict["tracking"] = self.set_tracking
+        # The linewidths (FWHM in ms) of the lockpoint peaks are measured within
+        # their ranges when requested, and during the lock every width_every-th
+        # step for the telemetry (0: never), see update_widths
+        self.width_every = 10
+        self.steps = 0
+        self.width_rows = np.zeros(0, dtype=int)  # rows of the lockpoint ranges
+        self.widths = np.zeros(0)  # latest width of each laser (nan if not found)
+        self.width_sum = np.zeros(0)  # sum and count of the widths since the last
+        self.width_count = np.zeros(0, dtype=int)  # telemetry poll
+        # timing of the phases of each locking step, see get_latency
+        self.latency = LatencyRing(
+            ("trigger", "readout", "peaks", "errors", "pid", "output")
+        )
+        self.action_dict["latency"] = self.get_latency
+        self.telemetry = LoopTelemetry()
+        self.action_dict["telemetry"] = self.get_telemetry
 
     def update_settings(self, settings):
+        error = self.check_settings(settings)
+        if error is not None:  # reject the settings before anything is changed
+            print(error)
+            return error
         inverts = []
         for key, val_dict in settings.items():  # iterate through the lasers
             if key not in self.settings.keys():
@@ -668,18 +1017,228 @@ class RP_Lock(RP, reaction_loop):
         self.invert = any(
             inverts
         )  # if any of the cavity signals needs inverting, invert
+        self.update_windows()
+        self.compile_plan()
         # print('update settings: {}'.format(self.settings))
         return "Updated lock setting!"
 
+    def compile_plan(self):
+        """
+        Compiles the settings into an immutable plan (a tuple of LaserPlan,
+        Master first) which is used by the locking steps, so that they do not
+        have to go through the settings dictionaries. Must be called whenever
+        the settings change. self.data holds views on self.peaks.
+        """
+        plan = []
+        row = 0
+        keys = sorted(self.settings, key=lambda key: key != "Master")
+        for key in keys:
+            val = self.settings[key]
+            master = key == "Master"
+            if master:
+                ranges = tuple(tuple(int(i) for i in r) for r in val["range"])
+            else:
+                ranges = (tuple(int(i) for i in val["range"]),)
+            name = val["peak_finder"]
+            finder = peak_finders[name]
+            if name[:2] == "SG":  # if savitzky golay filter involved, bind the matrix
+                finder = partial(finder, m=val["SG_m"])
+            elif val.get("finder_kwargs"):
+                finder = partial(finder, **val["finder_kwargs"])
+            if master and self.mode == "scan":
+                gen = self.gen_ramp
+            elif not master and self.mode == "lock":
+                gen = val.get("gen")
+            else:
+                gen = None
+            plan.append(
+                LaserPlan(key, master, ranges, finder, row, val["sign"], val["PID"], gen)
+            )
+            row += len(ranges)
+        self.peaks = np.zeros((row, 2))
+        self.data = dict()
+        for laser in plan:
+            if laser.master:  # positions in the first, heights in the second row
+                self.data[laser.key] = self.peaks[laser.row : laser.row + 2].T
+            else:
+                self.data[laser.key] = self.peaks[laser.row]
+        self.plan = tuple(plan)
+        # all ranges (in the order of the rows of self.peaks) are processed at once
+        self.peak_finder = BatchPeakFinder(
+            [r for laser in plan for r in laser.ranges],
+            [laser.finder for laser in plan for r in laser.ranges],
+        )
+        if self.tracked:  # settings changed during the lock
+            self.start_tracking()
+        # the lockpoint lies in the last range of each laser
+        self.bounds = np.array([laser.ranges[-1] for laser in plan], dtype=int)
+        self.bounds = self.bounds.reshape(-1, 2)
+        self.width_rows = np.array(
+            [laser.row + len(laser.ranges) - 1 for laser in plan], dtype=int
+        )
+        self.widths = np.full(len(plan), np.nan)
+        self.width_sum = np.zeros(len(plan))
+        self.width_count = np.zeros(len(plan), dtype=int)
+        self.lockpoints = self.ms2index(
+            [self.settings[laser.key]["lockpoint"] for laser in plan]
+        )
+
+    def check_settings(self, settings):
+        """
+        Checks the ranges (indices) and lockpoints (ms) which result from
+        merging settings into the current ones, before they are applied.
+        Returns an error message or None if the settings are valid.
+        """
+        keys, ranges, lockpoints = [], [], []
+        for key in set(self.settings) | set(settings):
+            val = dict(self.settings.get(key, {}))
+            val.update(settings.get(key, {}))
+            if not val.get("enabled", True):  # disabled lasers are removed anyway
+                continue
+            if "range" not in val or "lockpoint" not in val:
+                return "Error: range or lockpoint of {} missing.".format(key)
+            r = np.reshape(np.asarray(val["range"], dtype=float), (-1, 2))
+            if key == "Master" and len(r) != 2:
+                return "Error: Master needs two ranges."
+            name = val.get("peak_finder", "maximum")
+            if isinstance(name, dict):
+                name = name.get("name")
+            if name not in peak_finders:
+                return "Error: unknown peak finder {} for {}.".format(name, key)
+            keys.append(key)
+            ranges.append(r)
+            lockpoints.append(val["lockpoint"])
+        if not keys:
+            return None
+        # windows of all lasers at once: must be integer, non-empty and inside the trace
+        R = np.concatenate(ranges)
+        invalid = (R[:, 0] < 0) | (R[:, 1] > self.N) | (R[:, 0] >= R[:, 1])
+        invalid |= (R != np.round(R)).any(axis=1)
+        if invalid.any():
+            return "Error: invalid range {}.".format(R[invalid][0].astype(int).tolist())
+        bounds = np.array([r[-1] for r in ranges])
+        i = self.ms2index(lockpoints)
+        outside = ~((bounds[:, 0] < i) & (i < bounds[:, 1]))
+        if outside.any():
+            key = keys[int(np.argmax(outside))]
+            return "Error: lockpoint of {} out of range.".format(key)
+        return None
+
+    def set_dec(self, dec):
+        RP.set_dec(self, dec)
+        # the lockpoints keep their index (as the ranges do), so their time changes
+        for laser, lockpoint in zip(self.plan, self.index2ms(self.lockpoints)):
+            self.settings[laser.key]["lockpoint"] = float(lockpoint)
+            if laser.master:
+                self.Master_pos = float(lockpoint)
+
+    def update_windows(self):
+        # merge the ranges of all lasers into sorted, non-overlapping windows
+        ranges = []
+        for key, val in self.settings.items():
+            if key == "Master":
+                ranges += [tuple(r) for r in val["range"]]
+            else:
+                ranges.append(tuple(val["range"]))
+        windows = []
+        for i0, i1 in sorted(ranges):
+            i0, i1 = max(0, int(i0)), min(self.N, int(i1))
+            if windows and i0 <= windows[-1][1]:  # overlapping or adjacent
+                windows[-1][1] = max(windows[-1][1], i1)
+            else:
+                windows.append([i0, i1])
+        self.windows = tuple(tuple(w) for w in windows) or None
+
     def acquire_cav_signal(self):
-        acquisition = self.acquire_ch(self.ch)
-        acquisition *= (-1) ** self.invert
+        self.trigger()
+        self.latency.stamp(1)
+        if self.windows is None:
+            acquisition = self.read_ch(self.ch)
+            windows = ((0, len(acquisition)),)
+        else:
+            acquisition = self.read_ch_windows(self.ch, self.windows, self.trace)
+            windows = self.windows
+        if self.pipelining:
+            self.start_scan()  # the next scan is captured while this one is processed
+        if self.invert:
+            for i0, i1 in windows:
+                np.negative(acquisition[i0:i1], out=acquisition[i0:i1])
+        self.latency.stamp(2)
         return acquisition
 
+    def start_scan(self):
+        # the Master offset must not change during a scan, so it is deferred until now
+        if self.pending_offset is not None:
+            self.gen_ramp.offset = self.pending_offset
+            self.pending_offset = None
+        RP.start_scan(self)
+
+    def set_tracking(self, query):
+        # query: half width of the search windows in samples, 0 searches the whole ranges
+        self.tracking = max(int(query), 0)
+        if self.tracked:
+            self.start_tracking()
+        return "Tracking {}".format(
+            "window {}".format(self.tracking) if self.tracking else "disabled"
+        )
+
+    def start_tracking(self):
+        # reference heights of the rows of self.peaks, measured in setup_lock
+        heights = [
+            self.settings[laser.key].get("height", 0.0)
+            for laser in self.plan
+            for r in laser.ranges
+        ]
+        self.tracked = True
+        if self.tracking:
+            self.peak_finder.track(heights, self.track_threshold, self.tracking)
+        else:
+            self.peak_finder.untrack()
+
+    def stop_tracking(self):
+        self.tracked = False
+        self.peak_finder.untrack()
+
+    def set_pipeline(self, query):
+        # query: bool, whether to pipeline the scans during the next lock (scan mode only)
+        self.pipeline = bool(query)
+        return "Pipeline {}".format("enabled" if self.pipeline else "disabled")
+
+    def get_telemetry(self, query):
+        """
+        Returns the achieved rate of the lock loop, the histogram of the
+        intervals between iterations, the number of skipped points and the
+        number of saturated PID updates per laser since the last call, as well
+        as the mean linewidth (ms) of each laser (None if it was not measured).
+        """
+        result = self.telemetry.poll()
+        result["saturated"] = dict()
+        for key, val in self.settings.items():
+            result["saturated"][key] = val["PID"].saturated
+            val["PID"].saturated = 0
+        result["widths"] = dict()
+        for laser, w, n in zip(self.plan, self.width_sum, self.width_count):
+            result["widths"][laser.key] = float(w / n) if n else None
+        self.width_sum[:] = 0
+        self.width_count[:] = 0
+        return result
+
+    def get_latency(self, query):
+        """
+        Returns p50, p99 and max (in us) of the duration of each phase of the
+        recent locking steps. Use query 'reset' to start over afterwards.
+        """
+        summary = self.latency.summary()
+        if query == "reset":
+            self.latency.reset()
+        return summary
+
     def update_peak_finder(self, laser, values):
         name = values.pop("name")  # remove name from peak_finder settings
         if name[:2] == "SG":  # if savitzky golay filter is involved
             self.settings[laser]["SG_m"] = SG_array(**values)  # calculate conv. matrix
+            values = {}
+        self.settings[laser]["finder_kwargs"] = values  # e.g. level of the centroid
         self.settings[laser]["peak_finder"] = name
 
     def update_PID(self, laser, val):
@@ -701,10 +1260,11 @@ class RP_Lock(RP, reaction_loop):
             if laser in self.settings:
                 self.settings[laser]["PID"].on = val
 
-    def update_pos(self):
+    def update_pos(self, widths=False):
         """
         Method to obtain the current peak positions from the cavity
-        and write them into the setting dictionary.
+        and write them into the setting dictionary. If widths is True, the
+        linewidths are measured as well (see update_data).
 
         Returns
         -------
@@ -712,28 +1272,27 @@ class RP_Lock(RP, reaction_loop):
 
         """
         try:
-            self.update_data()
+            self.update_data(widths)
         except:
             self.skipped = True  # something failed, skip point!
             return
         self.skipped = False
-        for key in self.settings.keys():  # retrieve current cavity scan
-            if key == "Master":  # readout individual peak positions
-                pos = self.data[key][:, 1][
-                    0
-                ]  # d- self.Master_pos    # Master is (currently) the only key, where multiple positions are stored!
+        peaks = self.peaks
+        master_pos = peaks[1, 0]  # the Master rows come first, the second range is the reference
+        for laser in self.plan:  # retrieve current cavity scan
+            if laser.master:  # readout individual peak positions
+                pos = master_pos
             else:
-                pos = (
-                    self.data[key][0] - self.data["Master"][:, 1][0]
-                )  # take the relative position!
+                pos = peaks[laser.row, 0] - master_pos  # take the relative position!
+            s = self.settings[laser.key]
             # check whether a quick jump occured. This procedure should ignore outliers due to unexpected jumps! locking step ignored with feedback = Flase
-            if "position" in self.settings[key]:
-                if np.abs(pos - self.settings[key]["position"]) < 20e-3:
+            if "position" in s:
+                if abs(pos - s["position"]) < 20e-3:
                     self.feedback = True
                 else:
                     self.feedback = False
                     print("skipped point!")
-            self.settings[key]["position"] = pos
+            s["position"] = pos
 
     def check_sign(self, iters=100):
         """
@@ -765,6 +1324,7 @@ class RP_Lock(RP, reaction_loop):
                 ):  # if the error increased by more than 5 MHz, the sign is flipped.
                     val["sign"] = -val["sign"]
                     print("Sign for {} flipped!".format(key))
+        self.compile_plan()  # the plan contains the signs
 
     def setup_lock(self):
         print("setting up lock")
@@ -787,6 +1347,7 @@ class RP_Lock(RP, reaction_loop):
                 self.settings[key]["height"] = self.data[key][
                     1
                 ]  # readout current height of all peaks and save it
+        self.start_tracking()
         self.check_sign()
         print("Master_pos:", self.Master_pos)
 
@@ -829,19 +1390,30 @@ class RP_Lock(RP, reaction_loop):
         is used to verify that the peaks have sufficient distance to their
         range borders.
         """
+        self.latency.stamp(0)
         self.check_gpio_ext_trig()
         self.t = perf_counter() - self.t0
         self.update_pos()  # retrieve current peak positions
+        self.latency.stamp(3)
         if self.feedback == True:
-            for key, val in self.settings.items():
-                self.update_err(key)  # calculate individual errors
-                val["PID"].update(
-                    self.errs[key] * val["sign"], self.t
-                )  # update the corresponding PID!
-                if key == "Master" and self.mode == "scan":
-                    self.gen_ramp.offset = val["PID"].MV
-                elif key != "Master" and self.mode == "lock":
-                    val["gen"].offset = val["PID"].MV
+            plan, errs, t = self.plan, self.errs, self.t
+            for laser in plan:
+                self.update_err(laser.key)  # calculate individual errors
+            self.latency.stamp(4)
+            for laser in plan:
+                laser.pid.update(errs[laser.key] * laser.sign, t)  # update the corresponding PID!
+            self.latency.stamp(5)
+            for laser in plan:
+                if laser.gen is None:
+                    continue
+                if laser.master and self.pipelining:
+                    # the next scan is already running, the offset applies to the one after
+                    self.pending_offset = laser.pid.MV
+                else:
+                    laser.gen.offset = laser.pid.MV
+            self.latency.stamp(6)
+            if not self.skipped:  # otherwise, the stamps of the acquisition are missing
+                self.latency.commit()
 
         elif self.feedback == False:
             return
@@ -877,23 +1449,15 @@ class RP_Lock(RP, reaction_loop):
             True if lockpoints are in the range, False if not.
 
         """
-        Bools = []
-        for key, val in self.settings.items():
-            if key == "Master":
-                range = val["range"][1]
-                i0 = self.times[range[0]]
-                i1 = self.times[range[1]]
-            else:
-                range = val["range"]
-                i0 = self.times[range[0]]
-                i1 = self.times[range[1]]
-            v = val["lockpoint"]
-            if not (i0 < v < i1):
-                print("Lockpoint {} for {} out of range!".format(v, key))
-                Bools.append(False)
-            else:
-                Bools.append(True)
-        return all(Bools)
+        # the lockpoints and ranges are compared in index space (see compile_plan)
+        inside = (self.bounds[:, 0] < self.lockpoints) & (
+            self.lockpoints < self.bounds[:, 1]
+        )
+        for laser, ok in zip(self.plan, inside):
+            if not ok:
+                v = self.settings[laser.key]["lockpoint"]
+                print("Lockpoint {} for {} out of range!".format(v, laser.key))
+        return bool(inside.all())
 
     def check_positions(self, dmin=5e-3):
         """
@@ -911,28 +1475,19 @@ class RP_Lock(RP, reaction_loop):
 
         """
 
-        Bools = []
-        for key, val in self.settings.items():
-            if key == "Master":
-                range = val["range"][1]
-                i0 = self.times[range[0]] - self.Master_pos
-                i1 = self.times[range[1]] - self.Master_pos
-            else:
-                range = val["range"]
-                i0 = self.times[range[0]] - self.Master_pos
-                i1 = self.times[range[1]] - self.Master_pos
-            pos = val["position"]
-
-            if (abs(pos - i0) <= dmin) or (abs(pos - i1) <= dmin):
-                print("Position {} of {} too close to border!".format(pos, key))
-                Bools.append(False)
-            else:
-                Bools.append(True)
-        return all(Bools)
+        # borders of the ranges in ms, relative to the Master position
+        borders = self.index2ms(self.bounds) - self.Master_pos
+        positions = np.array([self.settings[laser.key]["position"] for laser in self.plan])
+        close = (np.abs(borders - positions[:, None]) <= dmin).any(axis=1)
+        for laser, pos, c in zip(self.plan, positions, close):
+            if c:
+                print("Position {} of {} too close to border!".format(pos, laser.key))
+        return not close.any()
 
     def loop_iter(self, *args, **kwargs):
         self.step()  # make a locking step
         self.iter_num += 1
+        self.telemetry.tick(self.skipped or not self.feedback)
 
     def start(self, *args, **kwargs):
         self.feedback = True
@@ -953,39 +1508,51 @@ class RP_Lock(RP, reaction_loop):
             self.errs_times = np.array([])
             self.errs_arr = []
             self.t0 = perf_counter()
-            self.start_loop()
-
-    def acquire_peaks(self, laser, r):
-        name = self.settings[laser]["peak_finder"]
-        peak_finder = peak_finders[name]
-        if name[:2] == "SG":  # if savitzky golay filter involved, give the matrix
-            m = self.settings[laser]["SG_m"]
-            return peak_finder(self.times, self.acquisition, r, m=m)
-        else:
-            return peak_finder(self.times, self.acquisition, r)
-
-    def get_peaks(self, laser, setting):
-        if laser == "Master":
-            P_l = []
-            for r in setting[
-                "range"
-            ]:  # 2 ranges for the master peak --> determination of frequency axis!
-                P = self.acquire_peaks(laser, r)
-                P_l.append(P)
-            return np.stack(P_l, axis=1)
-        else:
-            r = setting["range"]
-            P = self.acquire_peaks(laser, r)
-            return P
-
-    def update_data(self):
+            self.telemetry.t_prev = None
+            self.telemetry.reset()
+            self.pipelining = self.pipeline and self.mode == "scan"
+            try:
+                self.start_loop()
+            finally:
+                self.stop_tracking()
+                self.pipelining = False
+                self.pending_offset = None
+                # a pipelined scan might have been captured already, rearm for the next acquisition
+                self.scan_started = False
+                self.trigger_armed = False
+
+    def update_data(self, widths=False):
         """
-        Method to obtain the Master and Slave peaks and create data dictionary
+        Method to obtain the Master and Slave peaks and create data dictionary.
+        The linewidths are measured if widths is True and every width_every-th
+        step (see update_widths).
         """
         self.acquisition = (
             self.acquire_cav_signal()
         )  # acquire scope data and make a shortcut. only acquire the desired channel!
-        self.data = dict()
-        for key, val in self.settings.items():
-            self.data[key] = self.get_peaks(key, val)
-        self.FSR = np.abs(self.data["Master"][:, 0][0] - self.data["Master"][:, 1][0])
+        # the results end up in self.data, which are views on self.peaks
+        self.steps += 1
+        measure = widths or (self.width_every and not self.steps % self.width_every)
+        peaks = self.peak_finder(
+            self.times, self.acquisition, out=self.peaks, widths=measure
+        )
+        self.FSR = abs(peaks[0, 0] - peaks[1, 0])
+        if measure:
+            self.update_widths()
+
+    def update_widths(self):
+        """
+        Takes the widths of the lockpoint peaks from the last call of the peak
+        finder and adds them to the averages reported by get_telemetry.
+        """
+        np.take(self.peak_finder.widths, self.width_rows, out=self.widths)
+        found = ~np.isnan(self.widths)
+        self.width_sum[found] += self.widths[found]
+        self.width_count += found
+
+    def get_widths(self):
+        # latest linewidth (ms) of each laser, None if it was not found
+        return {
+            laser.key: None if np.isnan(w) else float(w)
+            for laser, w in zip(self.plan, self.widths)
+        }
@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+import os, sys
+
+# the modules of RP_side import each other by name, as they do on the redpitaya
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -4,7 +4,11 @@ Created on Tue May 10 10:19:27 2022
 
 @author: epultinevicius
 """
-import selectors, struct, json, io, sys
+import selectors, struct, json, io, sys, types
+import numpy as np
+
+# content-type for raw numpy buffers, negotiated through the 'accept' header
+NUMPY_CONTENT_TYPE = "application/x-numpy"
 
 class Message:
     def __init__(self, selector, sock, addr, action_dict = None, stop = True):
@@ -13,12 +17,15 @@ class Message:
         self.addr = addr
         self.action_dict = action_dict
         self._recv_buffer = b""
-        self._send_buffer = b""
+        self._send_buffer = [] # list of byte memoryviews, sent without joining them
         self._jsonheader_len = None
         self.jsonheader = None
         self.request = None
         self.response_created = False
         self.stop = stop # whether to stop after one message
+        self._keep_alive = False # set by the client to keep the connection open after a response
+        self._stream = None # generator returned by an action, its items are sent one by one
+        self._stream_count = 0
 
     def _set_selector_events_mask(self, mode):
         """Set selector to listen for events: mode is 'r', 'w', or 'rw'."""
@@ -33,7 +40,15 @@ class Message:
         self.selector.modify(self.sock, events, data=self)
     
     def _json_encode(self, obj, encoding):
-        return json.dumps(obj, ensure_ascii=False).encode(encoding)
+        return json.dumps(obj, ensure_ascii=False, default=self._json_default).encode(encoding)
+
+    def _json_default(self, obj):
+        # fallback for clients which do not accept numpy content: arrays become lists
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+        if isinstance(obj, np.generic):
+            return obj.item()
+        raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
 
     def _json_decode(self, json_bytes, encoding):
         tiow = io.TextIOWrapper(
@@ -44,18 +59,25 @@ class Message:
         return obj
 
     def _create_message(
-        self, *, content_bytes, content_type, content_encoding
+        self, *, content_bytes, content_type, content_encoding, header=None
     ):
+        # content_bytes is a bytes-like object or a list of them. The message
+        # is returned as a list of byte memoryviews, the content is not copied.
+        if not isinstance(content_bytes, list):
+            content_bytes = [content_bytes]
+        buffers = [memoryview(b).cast("B") for b in content_bytes]
+        buffers = [b for b in buffers if b.nbytes] # empty buffers would never be consumed
         jsonheader = {
             "byteorder": sys.byteorder,
             "content-type": content_type,
             "content-encoding": content_encoding,
-            "content-length": len(content_bytes),
+            "content-length": sum(b.nbytes for b in buffers),
         }
+        if header:
+            jsonheader.update(header) # additional fields, e.g. the numpy layout
         jsonheader_bytes = self._json_encode(jsonheader, "utf-8")
         message_hdr = struct.pack(">H", len(jsonheader_bytes))
-        message = message_hdr + jsonheader_bytes + content_bytes
-        return message
+        return [memoryview(message_hdr + jsonheader_bytes)] + buffers
 
     def process_events(self, mask): #handles the socket event to either read or write
         if mask & selectors.EVENT_READ:
@@ -76,11 +98,17 @@ class Message:
         else:
             if data:
                 self._recv_buffer += data
+            elif self._keep_alive and not self._recv_buffer and self._jsonheader_len is None:
+                # client closed a persistent connection in between two requests
+                self.close()
             else:
                 raise RuntimeError("Peer closed.")
     
     def read(self): 
         self._read()    #receive incoming message and store it in buffer
+        self.process_buffer()
+
+    def process_buffer(self):
         # cases: what to process?
         
         if self._jsonheader_len is None:    #first: fixed length header --> retrieve jsonheader length
@@ -125,6 +153,7 @@ class Message:
                 if reqhdr not in self.jsonheader:
                     raise ValueError("Missing required header '{}'.".format(reqhdr))
                     print('1.3')
+            self._keep_alive = self.jsonheader.get("keep-alive", False)
                 
     def process_request(self):
         content_len = self.jsonheader["content-length"]
@@ -149,28 +178,43 @@ class Message:
         if self._send_buffer:
             #print("Sending to {}".format(self.addr))
             try:
-                #Should be ready to write
-                sent = self.sock.send(self._send_buffer)
+                #Should be ready to write. sendmsg gathers the buffers without joining them
+                sent = self.sock.sendmsg(self._send_buffer)
             except BlockingIOError:
                 #Resource temporarily unavailable (errno EWOULDBLOCK)
                 pass
             else:
-                self._send_buffer = self._send_buffer[sent:]
+                self._consume_send_buffer(sent)
                 #Close when the buffer is drained. The response had been sent.
                 
                 if sent and not self._send_buffer:
-                    if self.stop:
+                    if self._stream is not None:
+                        # the next item of the stream is only created once the previous one is sent
+                        self._queue_response(self._next_stream_response())
+                    elif self.stop and not self._keep_alive:
                         self.close()
                     else: 
                         self._set_selector_events_mask("r")
-                        # reset everything
-                        self._recv_buffer = b""
-                        self._send_buffer = b""
+                        # reset everything, but keep requests that were already received
+                        self._send_buffer = []
                         self._jsonheader_len = None
                         self.jsonheader = None
                         self.request = None
                         self.response_created = False
+                        if self._recv_buffer:
+                            self.process_buffer()
                     
+    def _consume_send_buffer(self, sent):
+        # drop the sent bytes from the send buffer. Partially sent buffers are
+        # sliced, which does not copy the remaining data.
+        while sent:
+            nbytes = self._send_buffer[0].nbytes
+            if sent < nbytes:
+                self._send_buffer[0] = self._send_buffer[0][sent:]
+                break
+            del self._send_buffer[0]
+            sent -= nbytes
+
     def close(self):
         #print("Closing connection to {}".format(self.addr))
         try:
@@ -195,9 +239,13 @@ class Message:
         else:
             # Binary or unknown content-type
             response = self._create_response_binary_content()
-        message = self._create_message(**response)
+        self._queue_response(response)
         self.response_created = True
-        self._send_buffer += message
+
+    def _queue_response(self, response):
+        if "request-id" in self.jsonheader: # echo the id, such that the client can match the response
+            response.setdefault("header", {})["request-id"] = self.jsonheader["request-id"]
+        self._send_buffer += self._create_message(**response)
  
         
     def _create_response_json_content(self):
@@ -213,7 +261,36 @@ class Message:
             #content = {"result": self.action_dict[action](query)}
         else:
             content = {"result": "Error: invalid action '{}'.".format(action)}
-                
+
+        if isinstance(content["result"], types.GeneratorType):
+            # stream the result: one response per item, marked by 'more' in the jsonheader
+            self._stream = content["result"]
+            self._stream_count = 0
+            return self._next_stream_response()
+        return self._encode_content(content)
+
+    def _next_stream_response(self):
+        # the last response of a stream carries the number of items sent before
+        try:
+            item = next(self._stream)
+        except StopIteration:
+            self._stream = None
+            response = self._encode_content({"result": self._stream_count})
+            response.setdefault("header", {})["more"] = False
+        else:
+            self._stream_count += 1
+            response = self._encode_content({"result": item})
+            response.setdefault("header", {})["more"] = True
+        return response
+
+    def _encode_content(self, content):
+        if NUMPY_CONTENT_TYPE in self.jsonheader.get("accept", ""):
+            # the client can rebuild arrays from raw buffers, so do not convert them to lists
+            arrays = []
+            skeleton = self._extract_arrays(content, arrays)
+            if arrays:
+                return self._create_response_numpy_content(skeleton, arrays)
+
         content_encoding = "utf-8"
         response = {
             "content_bytes": self._json_encode(content, content_encoding),
@@ -222,6 +299,41 @@ class Message:
         }
         return response    
 
+    def _extract_arrays(self, obj, arrays):
+        # replace each array in obj by a placeholder and collect the arrays in order
+        if isinstance(obj, np.ndarray):
+            arrays.append(np.ascontiguousarray(obj))
+            return {"__ndarray__": len(arrays) - 1}
+        elif isinstance(obj, dict):
+            return {key: self._extract_arrays(val, arrays) for key, val in obj.items()}
+        elif isinstance(obj, (list, tuple)):
+            return [self._extract_arrays(val, arrays) for val in obj]
+        elif isinstance(obj, np.generic):
+            return obj.item()
+        return obj
+
+    def _create_response_numpy_content(self, skeleton, arrays):
+        # the content is made of the raw array buffers (8 byte aligned). Their
+        # dtype, shape and offset as well as the remaining json content are
+        # stored in the jsonheader. The arrays are sent from their own memory,
+        # so they must not be changed before the response is sent.
+        chunks, layout, offset = [], [], 0
+        for arr in arrays:
+            pad = -offset % 8
+            if pad:
+                chunks.append(bytes(pad))
+                offset += pad
+            layout.append([offset, arr.dtype.str, list(arr.shape)])
+            chunks.append(arr)
+            offset += arr.nbytes
+        response = {
+            "content_bytes": chunks,
+            "content_type": NUMPY_CONTENT_TYPE,
+            "content_encoding": "binary",
+            "header": {"numpy-skeleton": skeleton, "numpy-arrays": layout},
+        }
+        return response
+
     def _create_response_binary_content(self):
         response = {
             "content_bytes": b"First 10 bytes of request: "
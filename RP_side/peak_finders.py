@@ -7,6 +7,7 @@ Created on Tue May  2 18:59:11 2023
 
 import numpy as np
 from math import factorial
+from functools import partial, lru_cache
 
 def maximum(x, y, r):
     '''
@@ -20,12 +21,19 @@ def SG_array(window_size = 21, order = 2, deriv=0, rate=1): # based on https://s
     """
     calculates an array which is used for convolution in an savitky-golay filter
     with a window_size, order to smoothen the deriv-th derivative of some data.
+    The arrays are cached (see _SG_kernel), so the same parameters return the
+    same read-only array.
     """
+    return _SG_kernel(int(window_size), int(order), int(deriv), rate)
+
+@lru_cache(maxsize=64)
+def _SG_kernel(window_size, order, deriv, rate):
     # precompute coefficients
     half_window = (window_size -1) // 2
     order_range = range(order+1)
-    b = np.mat([[k**i for i in order_range] for k in range(-half_window, half_window+1)])
-    m = np.linalg.pinv(b).A[deriv] * rate**deriv * factorial(deriv)
+    b = np.array([[k**i for i in order_range] for k in range(-half_window, half_window+1)], dtype=float)
+    m = np.linalg.pinv(b)[deriv] * rate**deriv * factorial(deriv)
+    m.flags.writeable = False  # shared by everyone asking for the same kernel
     return m
 
 # some precalculated default value that worked well for our tests
@@ -41,7 +49,7 @@ def SG_filter(x,y,r, m=m_0):
     
 def SG_maximum(x,y,r, m = m_0):
     half_window = (len(m) - 1) // 2
-    x, y = np.array(x[r[0]:r[-1]]), np.array(y[r[0]:r[-1]])  #extract data in range
+    x, y = x[r[0]:r[-1]], y[r[0]:r[-1]]  #extract data in range (views, not copies)
     j = np.argmax(y)
     y2 = np.convolve( m[::-1], y[j-2*half_window : j+2*half_window], mode='valid')
     j2 = np.argmax(y2)
@@ -49,7 +57,7 @@ def SG_maximum(x,y,r, m = m_0):
 
 def SG_deriv(x,y,r, m = m_1):
     half_window = (len(m) - 1) // 2
-    x, y = np.array(x[r[0]:r[-1]]), np.array(y[r[0]:r[-1]])  #extract data in range
+    x, y = x[r[0]:r[-1]], y[r[0]:r[-1]]  #extract data in range (views, not copies)
     j = np.argmax(y)
     dv = np.convolve( m[::-1], y[j-half_window : j+half_window+2], mode='valid')
     x_p = x[j] - dv[0] * (x[j+1]-x[j]) / (dv[1]- dv[0])
@@ -58,12 +66,667 @@ def SG_deriv(x,y,r, m = m_1):
     else:
         return np.array([x[j], y[j]]) # if abnormal value, just take the maximum position.
     
+def minmax_indices(y, n):
+    """
+    Indices for a peak preserving decimation of y (e.g. for plotting): y is split
+    into n bins and the positions of the minimum and maximum of each bin are kept
+    in their original order. At most 2n+2 indices are returned.
+    """
+    N = len(y)
+    if N <= 2 * n:
+        return np.arange(N)
+    size = N // n
+    Y = np.reshape(y[: size * n], (n, size))
+    offsets = np.arange(0, size * n, size)
+    j = np.stack([np.argmin(Y, axis=1), np.argmax(Y, axis=1)], axis=1)
+    j = (np.sort(j, axis=1) + offsets[:, None]).ravel()
+    if size * n < N:  # the remaining points form a smaller, last bin
+        rest = y[size * n :]
+        j_rest = np.sort([np.argmin(rest), np.argmax(rest)]) + size * n
+        j = np.concatenate([j, j_rest])
+    return j
+
+def minmax_decimate(x, y, n):
+    """
+    Peak preserving decimation of the data x, y to about 2n points, see minmax_indices.
+    Narrow peaks stay visible, unlike when taking every k-th point.
+    """
+    j = minmax_indices(y, n)
+    return x[j], y[j]
+
     # dictionary containing all relevant peakfinders
 peak_finders = dict(
     maximum = maximum,
     SG_deriv = SG_deriv,
     SG_maximum = SG_maximum
     )
+
+################## batched peak finders ########################################
+# counterparts of the peak finders above, which refine the maxima (indices J in
+# the whole trace) of many ranges (rows of R) at once. Return positions and heights.
+
+def _batch_maximum(x, y, J, R):
+    return x[J], y[J]
+
+class SGFinder:
+    """
+    Base of the batched Savitzky-Golay peak finders. The smoothed values are
+    dot products of windows of the data (relative to the maxima: offsets)
+    with the kernel m. All intermediate results are written into work buffers
+    with out= arguments, which are allocated once per number of ranges, so
+    the calls do not allocate any arrays. The returned arrays are these
+    buffers, they are overwritten by the next call.
+    """
+    def __init__(self, m, offsets):
+        self.m = m
+        self.half_window = (len(m) - 1) // 2
+        # indices of the samples of each smoothed value relative to the maximum
+        self.offsets = offsets[:, None] + np.arange(len(m))
+        self.n = None
+
+    def _allocate(self, n):
+        shape = (n, len(self.offsets))
+        self.index = np.empty(shape + (len(self.m),), dtype=np.intp)
+        self.window = np.empty(self.index.shape)
+        self.smooth = np.empty(shape)
+        # 2D/1D views for a plain matrix-vector product (np.dot copies 3D arrays)
+        self._rows = self.window.reshape(-1, len(self.m))
+        self._values = self.smooth.reshape(-1)
+        self.position = np.empty(n)
+        self.height = np.empty(n)
+        self.n = n
+
+    def _smooth(self, y, J):
+        # smoothed values around the maxima J (rows)
+        if len(J) != self.n:
+            self._allocate(len(J))
+        np.add(J[:, None, None], self.offsets, out=self.index)
+        np.take(y, self.index, out=self.window, mode='clip')
+        np.dot(self._rows, self.m, out=self._values)
+        return self.smooth
+
+class SGMaximum(SGFinder):
+    """
+    Batched SG_maximum: maxima of the smoothed data around the raw maxima.
+    """
+    def __init__(self, m = m_0):
+        half_window = (len(m) - 1) // 2
+        SGFinder.__init__(self, m, np.arange(-2*half_window, 0))
+
+    def _allocate(self, n):
+        SGFinder._allocate(self, n)
+        self.first = np.empty(self.smooth.shape, dtype=np.intp)
+        self.outside = np.empty(self.smooth.shape, dtype=bool)
+        self.j = np.empty(n, dtype=np.intp)
+
+    def __call__(self, x, y, J, R):
+        y2 = self._smooth(y, J)
+        # as in SG_maximum, only smoothed values based on data inside the range count
+        first = np.add(J[:, None], self.offsets[:, 0], out=self.first)
+        np.copyto(y2, -np.inf, where=np.less(first, R[:, :1], out=self.outside))
+        last = np.add(first, 2*self.half_window, out=self.first)
+        np.copyto(y2, -np.inf, where=np.greater_equal(last, R[:, 1:], out=self.outside))
+        j = np.argmax(y2, axis=1, out=self.j)
+        np.max(y2, axis=1, out=self.height)
+        j += J
+        j -= self.half_window
+        np.take(x, j, out=self.position, mode='clip')
+        return self.position, self.height
+
+class SGDeriv(SGFinder):
+    """
+    Batched SG_deriv: zero crossing of the smoothed derivative between the raw
+    maximum and the next sample, found by linear interpolation.
+    """
+    def __init__(self, m = m_1):
+        half_window = (len(m) - 1) // 2
+        SGFinder.__init__(self, m, np.arange(-half_window, 2 - half_window))
+
+    def _allocate(self, n):
+        SGFinder._allocate(self, n)
+        self.shift = np.empty(n)
+        self.k = np.empty(n, dtype=np.intp)
+        self.ok = np.empty(n, dtype=bool)
+        self.inside = np.empty(n, dtype=bool)
+
+    def __call__(self, x, y, J, R):
+        dv = self._smooth(y, J)
+        # shift (in samples) of the zero crossing relative to the maximum
+        shift = np.subtract(dv[:, 1], dv[:, 0], out=self.shift)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(dv[:, 0], shift, out=shift)
+            # abnormal values due to interpolation errors: just take the maximum position
+            ok = np.less(np.abs(shift, out=self.position), self.half_window, out=self.ok)
+        # the same if the filter would need data outside of the range
+        k = np.subtract(J, self.half_window, out=self.k)
+        ok &= np.greater_equal(k, R[:, 0], out=self.inside)
+        k += 2*self.half_window + 2
+        ok &= np.less_equal(k, R[:, 1], out=self.inside)
+        np.copyto(shift, 0.0, where=np.logical_not(ok, out=self.inside))
+        shift *= x[1] - x[0]
+        np.take(x, J, out=self.position)
+        self.position -= shift
+        np.take(y, J, out=self.height)
+        return self.position, self.height
+
+def _vertex(y_l, y_0, y_r, ok):
+    # offset (in samples) and value of the vertex of the parabola through 3 points
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d = 0.5 * (y_l - y_r) / (y_l - 2*y_0 + y_r)
+        ok = ok & (np.abs(d) <= 1)  # flat or bumpy peaks: keep the maximum
+        d = np.where(ok, d, 0.0)
+        return d, np.where(ok, y_0 - 0.25 * (y_l - y_r) * d, y_0)
+
+class WindowFinder:
+    """
+    Base of the batched finders which interpolate the maximum from a window
+    of samples around it (relative to the maxima: offsets). As in SGFinder,
+    the work buffers are allocated once per number of ranges and the calls
+    do not allocate any arrays. The returned arrays are these buffers.
+    """
+    def __init__(self, offsets):
+        self.offsets = offsets
+        self.n = None
+
+    def _allocate(self, n):
+        shape = (n, len(self.offsets))
+        self.index = np.empty(shape, dtype=np.intp)
+        self.window = np.empty(shape)
+        self.inside = np.empty(shape, dtype=bool)  # samples in the range
+        self.mask = np.empty(shape, dtype=bool)
+        self.k = np.empty(n, dtype=np.intp)
+        self.ok = np.empty(n, dtype=bool)
+        self.test = np.empty(n, dtype=bool)
+        self.shift = np.empty(n)
+        self.position = np.empty(n)
+        self.height = np.empty(n)
+        self.n = n
+
+    def _window(self, y, J, R):
+        # windows around the maxima J (rows) and which of their samples lie in the range
+        if len(J) != self.n:
+            self._allocate(len(J))
+        np.add(J[:, None], self.offsets, out=self.index)
+        np.take(y, self.index, out=self.window, mode='clip')
+        np.greater_equal(self.index, R[:, :1], out=self.inside)
+        self.inside &= np.less(self.index, R[:, 1:], out=self.mask)
+        return self.window
+
+    def _position(self, x, J):
+        # position of the maximum J shifted by self.shift (in samples)
+        self.shift *= x[1] - x[0]
+        np.take(x, J, out=self.position)
+        self.position += self.shift
+        return self.position
+
+class VertexFinder(WindowFinder):
+    """
+    Base of the finders which take the vertex of the parabola through the
+    maximum and its two neighbours (see _vertex).
+    """
+    def __init__(self):
+        WindowFinder.__init__(self, np.arange(-1, 2))
+
+    def _allocate(self, n):
+        WindowFinder._allocate(self, n)
+        self.num = np.empty(n)
+        self.den = np.empty(n)
+        self.fallback = np.empty(n, dtype=bool)
+
+    def _neighbours(self, y, J, R):
+        # whether both neighbours of the maxima are in the range
+        Y = self._window(y, J, R)
+        np.logical_and(self.inside[:, 0], self.inside[:, 2], out=self.ok)
+        return Y
+
+    def _vertex(self, Y, ok, d, height):
+        # _vertex for the rows [y_l, y_0, y_r] of Y, written into d and height.
+        # ok is updated: False for flat or bumpy peaks, which keep the maximum.
+        y_l, y_0, y_r = Y[:, 0], Y[:, 1], Y[:, 2]
+        np.subtract(y_l, y_r, out=self.num)
+        np.add(y_l, y_r, out=self.den)
+        self.den -= y_0
+        self.den -= y_0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(self.num, self.den, out=d)
+            d *= 0.5
+            ok &= np.less_equal(np.abs(d, out=height), 1, out=self.test)
+        np.copyto(d, 0.0, where=np.logical_not(ok, out=self.test))
+        np.multiply(self.num, d, out=height)
+        height *= -0.25
+        height += y_0
+
+class Parabolic(VertexFinder):
+    """
+    Batched parabolic: vertex of the parabola through the maximum and its two
+    neighbours.
+    """
+    def __call__(self, x, y, J, R):
+        Y = self._neighbours(y, J, R)
+        self._vertex(Y, self.ok, self.shift, self.height)
+        return self._position(x, J), self.height
+
+class Gaussian(VertexFinder):
+    """
+    Batched gaussian: vertex of the parabola through the logarithm of the
+    maximum and its two neighbours, which is exact for gaussian peaks. If one
+    of them is not positive, the parabolic interpolation is used instead.
+    """
+    def _allocate(self, n):
+        VertexFinder._allocate(self, n)
+        self.log = np.zeros((n, 3))
+        self.ok_log = np.empty(n, dtype=bool)
+        self.positive = np.empty(n, dtype=bool)
+        self.shift_log = np.empty(n)
+        self.height_log = np.empty(n)
+
+    def __call__(self, x, y, J, R):
+        Y = self._neighbours(y, J, R)
+        np.greater(Y, 0, out=self.mask)
+        np.all(self.mask, axis=1, out=self.positive)
+        np.log(Y, out=self.log, where=self.mask)  # the others are not used
+        np.logical_and(self.ok, self.positive, out=self.ok_log)
+        self._vertex(self.log, self.ok_log, self.shift_log, self.height_log)
+        self._vertex(Y, self.ok, self.shift, self.height)
+        np.copyto(self.shift, self.shift_log, where=self.positive)
+        np.exp(self.height_log, out=self.height, where=self.positive)
+        return self._position(x, J), self.height
+
+class Centroid(WindowFinder):
+    """
+    Batched centroid: center of mass of the part of the peak above level
+    (fraction of the height above the minimum), within window_size samples
+    around the maximum.
+    """
+    def __init__(self, level = 0.5, window_size = 21):
+        half_window = (window_size - 1) // 2
+        WindowFinder.__init__(self, np.arange(-half_window, half_window + 1))
+        self.level = level
+        self.k_float = self.offsets.astype(float)
+
+    def _allocate(self, n):
+        WindowFinder._allocate(self, n)
+        self.weights = np.empty((n, len(self.offsets)))
+        self.base = np.empty(n)
+        self.total = np.empty(n)
+
+    def __call__(self, x, y, J, R):
+        W = self._window(y, J, R)
+        w = self.weights
+        np.copyto(w, W)
+        np.copyto(w, np.inf, where=np.logical_not(self.inside, out=self.mask))
+        base = np.min(w, axis=1, out=self.base)
+        np.take(y, J, out=self.height)
+        # threshold: base + level * (height - base)
+        threshold = np.subtract(self.height, base, out=self.total)
+        threshold *= self.level
+        threshold += base
+        np.subtract(W, threshold[:, None], out=w)
+        np.greater(w, 0, out=self.mask)
+        self.mask &= self.inside
+        np.copyto(w, 0.0, where=np.logical_not(self.mask, out=self.mask))
+        total = np.sum(w, axis=1, out=self.total)
+        np.dot(w, self.k_float, out=self.shift)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.shift /= total
+        np.copyto(self.shift, 0.0, where=np.less_equal(total, 0, out=self.test))
+        return self._position(x, J), self.height
+
+class Lorentzian(WindowFinder):
+    """
+    Batched lorentzian: least squares fit of a lorentzian to window_size
+    samples around the maximum. 1/y of a lorentzian is a parabola
+    a + b*k + c*k**2, which is fitted with weights y**2 (turning the residuals
+    of 1/y into residuals of y). The normal equations are solved in closed
+    form, by the adjugate of their (symmetric) matrix.
+    """
+    # entries (row, column) of the adjugate of the matrix of sums S[i+j] as
+    # S[p]*S[q] - S[r]*S[s]
+    COFACTORS = (
+        (0, 0, 2, 4, 3, 3),
+        (0, 1, 2, 3, 1, 4),
+        (0, 2, 1, 3, 2, 2),
+        (1, 1, 0, 4, 2, 2),
+        (1, 2, 1, 2, 0, 3),
+        (2, 2, 0, 2, 1, 1),
+        )
+
+    def __init__(self, window_size = 11):
+        half_window = (window_size - 1) // 2
+        WindowFinder.__init__(self, np.arange(-half_window, half_window + 1))
+        self.half_window = half_window
+        self.powers = (self.offsets[:, None] ** np.arange(5)).astype(float)  # k**0 ... k**4
+        self.powers3 = np.ascontiguousarray(self.powers[:, :3])
+
+    def _allocate(self, n):
+        WindowFinder._allocate(self, n)
+        self.W2 = np.empty((n, len(self.offsets)))
+        self.W3 = np.empty((n, len(self.offsets)))
+        self.S = np.empty((n, 5))  # sums of y**4 * k**p
+        self.v = np.empty((n, 3, 1))  # sums of y**3 * k**p
+        self.adjugate = np.empty((n, 3, 3))
+        self.product = np.empty((n, 3))
+        self.det = np.empty(n)
+        self.tmp = np.empty(n)
+        self.p = np.empty((n, 3, 1))  # a, b, c
+
+    def __call__(self, x, y, J, R):
+        W = self._window(y, J, R)
+        np.greater(W, 0, out=self.mask)
+        self.mask &= self.inside
+        # samples without signal do not count
+        np.copyto(W, 0.0, where=np.logical_not(self.mask, out=self.mask))
+        np.multiply(W, W, out=self.W2)
+        np.multiply(self.W2, W, out=self.W3)
+        np.dot(self.W3, self.powers3, out=self.v[:, :, 0])
+        np.multiply(self.W2, self.W2, out=self.W2)
+        S = np.dot(self.W2, self.powers, out=self.S)
+        A = self.adjugate
+        for i, j, p, q, r, s in self.COFACTORS:
+            np.multiply(S[:, p], S[:, q], out=A[:, i, j])
+            A[:, i, j] -= np.multiply(S[:, r], S[:, s], out=self.tmp)
+            if i != j:
+                A[:, j, i] = A[:, i, j]
+        np.multiply(S[:, :3], A[:, 0], out=self.product)
+        det = np.sum(self.product, axis=1, out=self.det)
+        np.matmul(A, self.v, out=self.p)
+        a, b, c = self.p[:, 0, 0], self.p[:, 1, 0], self.p[:, 2, 0]
+        d, height = self.shift, self.height
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            self.p /= det[:, None, None]  # singular systems result in inf or nan
+            np.divide(b, c, out=d)
+            d *= -0.5
+            np.multiply(b, d, out=height)  # vertex: a + b*d + c*d**2 = a + b*d/2
+            height *= 0.5
+            height += a
+            np.reciprocal(height, out=height)
+            ok = np.not_equal(det, 0, out=self.ok)
+            ok &= np.greater(c, 0, out=self.test)
+            ok &= np.less_equal(np.abs(d, out=self.tmp), self.half_window, out=self.test)
+            ok &= np.greater(height, 0, out=self.test)
+        np.logical_not(ok, out=ok)  # failed fit: keep the maximum
+        np.copyto(d, 0.0, where=ok)
+        np.take(y, J, out=self.tmp)
+        np.copyto(height, self.tmp, where=ok)
+        return self._position(x, J), height
+
+def _from_batch(batch, name):
+    # the peak finder for a single range r, based on the batched version
+    def finder(x, y, r, **kwargs):
+        R = np.array([[r[0], r[-1]]])
+        J = r[0] + np.argmax(y[r[0]:r[-1]]).reshape(1)
+        position, height = batch(**kwargs)(x, y, J, R)
+        return np.array([position[0], height[0]])
+    finder.__name__ = name
+    finder.__doc__ = batch.__doc__
+    return finder
+
+# sub-sample interpolation of the maximum, see the batched versions above
+parabolic = _from_batch(Parabolic, "parabolic")
+gaussian = _from_batch(Gaussian, "gaussian")
+centroid = _from_batch(Centroid, "centroid")
+lorentzian = _from_batch(Lorentzian, "lorentzian")
+
+peak_finders.update(
+    parabolic = parabolic,
+    gaussian = gaussian,
+    centroid = centroid,
+    lorentzian = lorentzian,
+    )
+
+batch_finders = {
+    maximum: _batch_maximum,
+    SG_maximum: SGMaximum,
+    SG_deriv: SGDeriv,
+    parabolic: Parabolic,
+    gaussian: Gaussian,
+    centroid: Centroid,
+    lorentzian: Lorentzian,
+    }
+
+def find_peaks(x, y, prominence, distance = 1):
+    """
+    Finds all peaks of y which stand out from their surroundings by at least
+    prominence, in vectorized passes over the whole trace (no ranges needed).
+    Starting from all local maxima, candidates are removed as long as their
+    prominence is provably too small: towards a higher neighbouring candidate
+    (or the end of the trace) the minimum in between is the exact reference.
+    Peaks closer than distance samples to a higher peak are removed, going
+    from the highest peak down (as scipy.signal.find_peaks does).
+    Returns an array with one row [position, height, width] per peak, sorted by
+    position. Position and height are interpolated with a parabola, except for
+    flat tops, which are represented by their middle and their sampled height.
+    The width is the full width at half prominence (in units of x).
+
+    A peak only suppressed by a peak which is suppressed itself is kept:
+
+    >>> x = np.arange(21.0)
+    >>> y = np.zeros(21)
+    >>> y[[5, 10, 15]] = [1, 2, 3]
+    >>> find_peaks(x, y, 0.5, distance=6)[:, 0]
+    array([ 5., 15.])
+    """
+    y = np.asarray(y, dtype=float)
+    N = len(y)
+    d = np.diff(y)
+    P = np.flatnonzero((d[:-1] > 0) & (d[1:] <= 0)) + 1  # local maxima (first sample of plateaus)
+    while len(P):
+        h = y[P]
+        # minima between neighbouring candidates (and the ends of the trace)
+        minima = np.minimum.reduceat(y, np.concatenate([[0], P]))
+        exact_l = np.concatenate([[True], h[:-1] > h[1:]])
+        exact_r = np.concatenate([h[1:] > h[:-1], [True]])
+        upper = h - np.maximum(np.where(exact_l, minima[:-1], -np.inf),
+                               np.where(exact_r, minima[1:], -np.inf))
+        low = upper < prominence
+        if not low.any():
+            break
+        P = P[~low]
+    if len(P) > 1 and (np.diff(P) < distance).any():
+        P = _suppress(P, y[P], distance)
+    if not len(P):
+        return np.zeros((0, 3))
+    h = y[P]
+    minima = np.minimum.reduceat(y, np.concatenate([[0], P]))
+    level = h - 0.5 * (h - np.maximum(minima[:-1], minima[1:]))  # half prominence
+    # the crossings of level are searched between the neighbouring peaks
+    bounds = np.concatenate([[0], P, [N - 1]])
+    left = _crossing(y, P, bounds[:-2], level, -1)
+    right = _crossing(y, P, bounds[2:], level, +1)
+    dx = x[1] - x[0]
+    shift, height = _vertex(y[P - 1], h, y[np.minimum(P + 1, N - 1)], P < N - 1)
+    # flat tops (P is their first sample): the last sample before y decreases
+    decrease = np.flatnonzero(d < 0)
+    end = np.append(decrease, N - 1)[np.searchsorted(decrease, P)]
+    flat = end > P
+    shift[flat] = 0.5 * (end[flat] - P[flat])
+    height[flat] = h[flat]
+    return np.stack([x[P] + shift * dx, height, (right - left) * dx], axis=1)
+
+def _suppress(P, h, distance):
+    # greedy non-maximum suppression of the peaks P (sorted) with the heights h:
+    # the remaining peaks remove their neighbours closer than distance, highest first
+    keep = np.ones(len(P), dtype=bool)
+    for i in np.argsort(h, kind='stable')[::-1]:
+        if keep[i]:
+            lo = np.searchsorted(P, P[i] - distance, side='right')
+            hi = np.searchsorted(P, P[i] + distance, side='left')
+            keep[lo:hi] = False
+            keep[i] = True
+    return P[keep]
+
+def _crossing(y, P, bounds, level, direction):
+    # fractional index at which y drops below level, going from the peaks P in
+    # direction (-1 or +1) up to bounds
+    L = int(np.abs(bounds - P).max()) + 1
+    idx = P[:, None] + direction * np.arange(L)
+    idx = np.clip(idx, np.minimum(P, bounds)[:, None], np.maximum(P, bounds)[:, None])
+    below = y[idx] < level[:, None]
+    j = np.argmax(below, axis=1)  # first sample below level (0 if there is none)
+    rows = np.arange(len(P))
+    a, b = idx[rows, np.maximum(j - 1, 0)], idx[rows, j]  # last one above, first one below
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(b != a, (y[a] - level) / (y[a] - y[b]), 0.0)
+    return a + t * (b - a)
+
+class BatchPeakFinder:
+    """
+    Finds the peaks in several ranges of the same trace in one pass. The ranges
+    are gathered into a padded 2D array (shorter ranges repeat their last
+    index), such that the maxima of all ranges are found by a single argmax.
+    The refinement (e.g. Savitzky-Golay smoothing, see SGFinder) is done at
+    once for all ranges sharing a finder. finders are the peak finders of
+    the ranges (functions or partials binding their keyword arguments); those
+    without a batched version are called per range. Optionally, the width
+    of each peak is measured as well (see widths).
+    """
+    def __init__(self, ranges, finders):
+        ranges = np.asarray(ranges, dtype=int).reshape(-1, 2)
+        self.n = len(ranges)
+        L = int((ranges[:, 1] - ranges[:, 0]).max()) if self.n else 0
+        self.index = np.minimum(ranges[:, :1] + np.arange(L), ranges[:, 1:] - 1)
+        self.ranges = ranges
+        groups = dict()
+        self.single = []  # (row, finder, range) of finders which are not batched
+        for row, (finder, r) in enumerate(zip(finders, ranges)):
+            func, kwargs = finder, {}
+            if isinstance(finder, partial):
+                func, kwargs = finder.func, finder.keywords
+            if func in batch_finders:
+                # arrays (e.g. SG kernels) are shared, so they are compared by identity
+                key = (func, tuple(
+                    (name, val if np.isscalar(val) else id(val))
+                    for name, val in sorted(kwargs.items())
+                    ))
+                groups.setdefault(key, (batch_finders[func], kwargs, []))[2].append(row)
+            else:
+                self.single.append((row, finder, tuple(r)))
+        self.groups = []
+        for batch, kwargs, rows in groups.values():
+            if rows == list(range(rows[0], rows[-1] + 1)):
+                rows = slice(rows[0], rows[-1] + 1)  # basic indexing, cheaper
+            if isinstance(batch, type):  # finder objects with their own work buffers
+                f = batch(**kwargs)
+            else:
+                f = partial(batch, **kwargs)
+            self.groups.append((f, rows, ranges[rows]))
+        # work buffers for the search of the maxima
+        self.window = np.empty(self.index.shape)
+        self.J = np.empty(self.n, dtype=np.intp)
+        # full widths at half maximum of the peaks (in units of x), measured within
+        # the ranges (see _widths). nan if the peak does not drop to half maximum.
+        self.widths = np.full(self.n, np.nan)
+        self._k = np.arange(L)
+        self._rows = np.arange(self.n) * L  # start of each row in the flattened window
+        self._below = np.empty(self.index.shape, dtype=bool)
+        self._side = np.empty(self.index.shape, dtype=bool)
+        self.tracking = False
+        self.last = None  # maxima of the previous call while tracking
+
+    def track(self, heights, threshold = 0.5, width = 16, max_width = 256):
+        """
+        Searches the maxima only in windows around the previous ones, so the
+        cost does not depend on the length of the ranges. The half width of the
+        windows adapts to the recent movement of the peaks (between width and
+        max_width samples). A range is searched completely if its peak is not
+        tracked yet, may have left the window, or is lower than threshold times
+        its reference height (heights, one per range).
+        """
+        self.heights = [threshold * h for h in heights]
+        # the windows must fit into the shortest range
+        shortest = int((self.ranges[:, 1] - self.ranges[:, 0]).min()) if self.n else 1
+        max_width = min(max(width, max_width), (shortest - 1) // 2)
+        width = min(width, max_width)
+        self.min_width, self.max_width = width, max_width
+        self.bounds = self.ranges.tolist()
+        self.width = width
+        self.last = None
+        self.tracking = True
+
+    def untrack(self):
+        self.tracking = False
+        self.last = None
+
+    def _maxima(self, y):
+        # indices of the maxima of all ranges
+        J = self.J
+        if self.last is None:
+            np.take(y, self.index, out=self.window, mode='clip')  # 'raise' would buffer out
+            np.argmax(self.window, axis=1, out=J)
+            J += self.ranges[:, 0]
+        else:
+            # There are only a few ranges, so they are handled one by one: slicing
+            # the small windows is cheaper than gathering them into a 2D array.
+            w = self.width
+            for i, ((lo, r1), last, height) in enumerate(zip(self.bounds, self.last, self.heights)):
+                # window of 2w+1 samples around the last maximum, shifted into the range
+                hi = r1 - (2*w + 1)
+                start = min(max(last - w, lo), hi)
+                j = int(np.argmax(y[start : start + 2*w + 1]))
+                # at the border of the window (but not of the range), the peak may be outside
+                if (j == 0 and start > lo) or (j == 2*w and start < hi) or y[start + j] < height:
+                    start, j = lo, int(np.argmax(y[lo:r1]))
+                J[i] = start + j
+        if self.tracking:
+            J_list = J.tolist()
+            if self.last is not None:
+                moved = max(abs(a - b) for a, b in zip(J_list, self.last))
+                self.width = min(max(2 * moved, self.min_width), self.max_width)
+            self.last = J_list
+        return J
+
+    def _widths(self, x, J):
+        # Half maximum between the maximum and the minimum (baseline) of each
+        # range, in self.window. The last sample below it left of the maximum
+        # and the first one right of it (padding repeats the last sample of the
+        # range) bound the peak, the crossings are linearly interpolated.
+        W = self.window
+        p = J - self.ranges[:, 0]  # maxima in the windows
+        level = W.min(axis=1)
+        level += W.take(self._rows + p)
+        level *= 0.5
+        below = np.less(W, level[:, None], out=self._below)
+        # left: last sample below the level before the maximum
+        side = np.less(self._k, p[:, None], out=self._side)
+        side &= below
+        i_l = len(self._k) - 1 - np.argmax(side[:, ::-1], axis=1)
+        found = side.take(self._rows + i_l)
+        # right: first sample below the level after the maximum
+        side = np.greater(self._k, p[:, None], out=self._side)
+        side &= below
+        i_r = np.argmax(side, axis=1)
+        found &= side.take(self._rows + i_r)
+        # (rows without crossing may index their neighbours, they are discarded)
+        b_l, a_l = W.take(self._rows + i_l), W.take(self._rows + i_l + 1, mode='clip')
+        a_r, b_r = W.take(self._rows + i_r - 1, mode='clip'), W.take(self._rows + i_r)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            left = i_l + (level - b_l) / (a_l - b_l)
+            right = i_r - (level - b_r) / (a_r - b_r)
+        np.subtract(right, left, out=self.widths)
+        self.widths *= x[1] - x[0]
+        np.copyto(self.widths, np.nan, where=~found)
+
+    def __call__(self, x, y, out = None, widths = False):
+        """
+        Returns the positions (first column) and heights of the peaks of all
+        ranges. If widths is True, the widths of the peaks are measured, too
+        (see self.widths).
+        """
+        if out is None:
+            out = np.zeros((self.n, 2))
+        if not self.n:
+            return out
+        gathered = self.last is None  # otherwise self.window is not updated
+        J = self._maxima(y)
+        if widths:
+            if not gathered:
+                np.take(y, self.index, out=self.window, mode='clip')
+            self._widths(x, J)
+        for f, rows, R in self.groups:
+            out[rows, 0], out[rows, 1] = f(x, y, J[rows], R)
+        for row, finder, r in self.single:
+            out[row] = finder(x, y, r)
+        return out
     
 ################## old functions ##############################################    
 def T123(x, y, r):
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the settings checks of RP_Lock. They need the redpitaya package (only
+available on the redpitaya), but no hardware: check_settings only uses N, dec
+and the current settings.
+"""
+import numpy as np
+import pytest
+
+pytest.importorskip("redpitaya")
+from RP_Lock import RP_Lock
+
+
+def make_lock(settings=None):
+    lock = RP_Lock.__new__(RP_Lock)  # without connecting to the hardware
+    lock.N, lock.dec = 2**14, 1
+    lock.settings = settings or {}
+    return lock
+
+
+def laser(lock, R, i):
+    # settings of a laser with the ranges R and the lockpoint at index i
+    return dict(range=R, lockpoint=float(lock.index2ms(i)), enabled=True)
+
+
+def test_valid_settings():
+    lock = make_lock()
+    settings = dict(
+        Master=laser(lock, [[2500, 3500], [11500, 12500]], 12000),
+        Slave1=laser(lock, [6500, 7500], 7000),
+    )
+    assert lock.check_settings(settings) is None
+
+
+def test_master_ranges_in_any_order():
+    lock = make_lock()
+    settings = dict(Master=laser(lock, [[11500, 12500], [2500, 3500]], 3000))
+    assert lock.check_settings(settings) is None
+
+
+@pytest.mark.parametrize(
+    "R", [[-1, 100], [6500, 2**14 + 1], [7500, 6500], [6500.5, 7500]]
+)
+def test_invalid_range(R):
+    lock = make_lock()
+    settings = dict(
+        Master=laser(lock, [[2500, 3500], [11500, 12500]], 12000),
+        Slave1=laser(lock, R, 7000),
+    )
+    assert lock.check_settings(settings).startswith("Error: invalid range")
+
+
+def test_lockpoint_out_of_range():
+    lock = make_lock()
+    # the Master lockpoint has to lie in its second range
+    settings = dict(Master=laser(lock, [[2500, 3500], [11500, 12500]], 3000))
+    assert "out of range" in lock.check_settings(settings)
+
+
+def test_merged_with_current_settings():
+    lock = make_lock()
+    lock.settings = dict(Slave1=laser(lock, [6500, 7500], 7000))
+    # only the range changes, the current lockpoint is left outside of it
+    assert "out of range" in lock.check_settings(dict(Slave1=dict(range=[100, 200])))
+    # disabled lasers are not checked
+    assert lock.check_settings(dict(Slave1=dict(range=[100, 200], enabled=False))) is None
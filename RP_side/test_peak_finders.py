@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the peak finders on synthetic traces: the batched finders against the
+per-range functions, and the interpolating finders against the exact positions
+and heights of the peak shapes they are made for.
+"""
+from functools import partial
+
+import numpy as np
+import pytest
+
+from peak_finders import (
+    SG_array,
+    SG_deriv,
+    SG_maximum,
+    BatchPeakFinder,
+    _suppress,
+    centroid,
+    find_peaks,
+    gaussian,
+    lorentzian,
+    maximum,
+    parabolic,
+    peak_finders,
+)
+
+N = 2**14
+x = np.arange(N) * 1.28e-4  # in ms, as for dec = 1
+i = np.arange(N)
+ranges = [(2500, 3500), (6500, 7500), (11500, 12500)]
+centers = (3000.3, 7000.7, 12000.45)
+
+
+def lorentzians(height=1.0, width=5.0, offset=0.0):
+    return offset + sum(height / (1 + ((i - c) / width) ** 2) for c in centers)
+
+
+def gaussians(height=1.0, width=8.0, offset=0.0):
+    return offset + sum(height * np.exp(-0.5 * ((i - c) / width) ** 2) for c in centers)
+
+
+def noisy(y, seed=0):
+    return y + 0.01 * np.random.default_rng(seed).standard_normal(N)
+
+
+finders = [
+    maximum,
+    partial(SG_maximum, m=SG_array()),
+    partial(SG_deriv, m=SG_array(order=1, deriv=1)),
+    parabolic,
+    gaussian,
+    partial(centroid, level=0.3, window_size=15),
+    partial(lorentzian, window_size=9),
+]
+
+
+@pytest.mark.parametrize("finder", finders)
+def test_batch_matches_single_range(finder):
+    y = noisy(lorentzians())
+    batch = BatchPeakFinder(ranges, [finder] * len(ranges))
+    expected = np.array([finder(x, y, r) for r in ranges])
+    np.testing.assert_allclose(batch(x, y), expected, rtol=1e-12, atol=1e-12)
+    # the work buffers are reused by the next call
+    np.testing.assert_allclose(batch(x, y), expected, rtol=1e-12, atol=1e-12)
+
+
+def test_mixed_finders():
+    y = noisy(gaussians())
+    fs = [partial(SG_maximum, m=SG_array()), parabolic, maximum]
+    expected = np.array([f(x, y, r) for f, r in zip(fs, ranges)])
+    np.testing.assert_allclose(BatchPeakFinder(ranges, fs)(x, y), expected)
+
+
+@pytest.mark.parametrize(
+    "finder, y",
+    [
+        (gaussian, gaussians(height=0.8, offset=0.0)),
+        (partial(lorentzian, window_size=11), lorentzians(height=0.8)),
+    ],
+)
+def test_exact_peak_shapes(finder, y):
+    # the finders reproduce position and height of their own peak shape
+    for r, c in zip(ranges, centers):
+        position, height = finder(x, y, r)
+        assert position == pytest.approx(c * 1.28e-4, abs=1e-3 * 1.28e-4)
+        assert height == pytest.approx(0.8, rel=1e-3)
+
+
+def test_lorentzian_height():
+    # peak height 1, half width 1 sample, between two samples
+    y = 1 / (1 + (i - 100.3) ** 2)
+    position, height = lorentzian(x, y, [50, 150])
+    assert position == pytest.approx(100.3 * 1.28e-4)
+    assert height == pytest.approx(1.0)
+
+
+def test_parabola_vertex():
+    y = 1.0 - 0.01 * (i - 3000.25) ** 2
+    position, height = parabolic(x, y, [2900, 3100])
+    assert position == pytest.approx(3000.25 * 1.28e-4)
+    assert height == pytest.approx(1.0)
+
+
+def test_centroid_of_symmetric_peak():
+    y = gaussians()
+    for r, c in zip(ranges, centers):
+        position, height = centroid(x, y, r, window_size=41)
+        assert position == pytest.approx(c * 1.28e-4, abs=0.02 * 1.28e-4)
+
+
+def test_peak_at_the_border_keeps_the_maximum():
+    y = np.zeros(N)
+    y[2500], y[2501] = 1.0, 0.5  # no left neighbour in the range
+    for name in ("parabolic", "gaussian"):
+        assert np.array_equal(peak_finders[name](x, y, [2500, 3500]), [x[2500], 1.0])
+
+
+def drifting_traces(steps=300, seed=1):
+    # lorentzians drifting by a few samples per trace; one jumps far and
+    # one drops below the tracking threshold for a while
+    rng = np.random.default_rng(seed)
+    c = np.array(centers)
+    for t in range(steps):
+        c = c + rng.normal(0, 2, 3)
+        if t == 100:
+            c[1] += 300  # beyond any search window
+        h = np.array([1.0, 1.0, 0.3 if 200 < t < 210 else 1.0])
+        y = sum(hh / (1 + ((i - cc) / 5) ** 2) for hh, cc in zip(h, c))
+        yield y + 0.005 * rng.standard_normal(N)
+
+
+def test_tracking_matches_full_search():
+    fs = [partial(SG_maximum, m=SG_array())] * 2 + [partial(SG_deriv, m=SG_array(order=1, deriv=1))]
+    full = BatchPeakFinder(ranges, fs)
+    tracked = BatchPeakFinder(ranges, fs)
+    tracked.track([1, 1, 1], threshold=0.5, width=16)
+    for y in drifting_traces():
+        np.testing.assert_array_equal(tracked(x, y), full(x, y))
+
+
+def test_tracking_windows_fit_into_the_ranges():
+    batch = BatchPeakFinder([(100, 141), (1000, 5000)], [maximum] * 2)
+    batch.track([1, 1], width=16, max_width=256)
+    assert batch.max_width == 20  # (41 - 1) // 2
+    batch.untrack()
+    assert not batch.tracking and batch.last is None
+
+
+def suppress_reference(P, h, distance):
+    # scipy.signal.find_peaks: from the highest peak down, each remaining
+    # peak removes its neighbours closer than distance
+    keep = np.ones(len(P), dtype=bool)
+    for j in np.argsort(h, kind="stable")[::-1]:
+        if keep[j]:
+            close = np.abs(P - P[j]) < distance
+            close[j] = False
+            keep &= ~close
+    return P[keep]
+
+
+def test_suppress_matches_reference():
+    rng = np.random.default_rng(0)
+    for t in range(500):
+        P = np.unique(rng.integers(0, 300, rng.integers(1, 60)))
+        h = rng.integers(0, 5, len(P)).astype(float)  # with ties
+        distance = int(rng.integers(1, 30))
+        np.testing.assert_array_equal(_suppress(P, h, distance), suppress_reference(P, h, distance))
+
+
+def test_find_peaks_chain():
+    # the peak at 5 is only close to the peak at 10, which is suppressed by 15
+    y = np.zeros(21)
+    y[[5, 10, 15]] = [1, 2, 3]
+    peaks = find_peaks(np.arange(21.0), y, 0.5, distance=6)
+    np.testing.assert_array_equal(peaks[:, :2], [[5, 1], [15, 3]])
+
+
+def test_find_peaks_plateau():
+    y = np.zeros(40)
+    y[10:14] = 1.0
+    np.testing.assert_allclose(find_peaks(np.arange(40.0), y, 0.5), [[11.5, 1.0, 4.0]])
+
+
+def test_find_peaks_all_resonances():
+    y = noisy(lorentzians(height=1.0, width=5.0, offset=0.1))
+    peaks = find_peaks(x, y, prominence=0.2, distance=50)
+    np.testing.assert_allclose(peaks[:, 0], np.array(centers) * 1.28e-4, atol=0.2 * 1.28e-4)
+    np.testing.assert_allclose(peaks[:, 1], 1.1, atol=0.02)
+    np.testing.assert_allclose(peaks[:, 2], 10 * 1.28e-4, rtol=0.05)  # FWHM = 2 * width
+    # the peaks agree with the maxima of the per-range finder
+    expected = np.array([parabolic(x, y, r) for r in ranges])
+    np.testing.assert_allclose(peaks[:, :2], expected)
+
+
+def test_find_peaks_nothing_found():
+    assert find_peaks(x, np.zeros(N), 0.1).shape == (0, 3)
+
+
+def test_widths():
+    # FWHM of a lorentzian is twice its half width, measured above the baseline
+    y = lorentzians(height=1.0, width=8.0, offset=0.3)
+    batch = BatchPeakFinder(ranges, [partial(SG_maximum, m=SG_array())] * 3)
+    batch(x, y, widths=True)
+    np.testing.assert_allclose(batch.widths, 16 * 1.28e-4, rtol=0.01)
+    # with noise, the baseline (minimum) is as low as for find_peaks
+    y = noisy(y, seed=2)
+    batch(x, y, widths=True)
+    np.testing.assert_allclose(batch.widths, find_peaks(x, y, 0.5, 50)[:, 2], rtol=0.03)
+
+
+def test_widths_within_the_ranges():
+    y = np.zeros(N)
+    y[3000] = 1.0  # single sample: crossings half way to the neighbours
+    y[6500:7500] = 1.0  # never drops to half maximum inside the range
+    y[7000] = 2.0
+    y[11500:12500] = 0.5  # no peak above the baseline
+    batch = BatchPeakFinder(ranges, [maximum] * 3)
+    batch(x, y, widths=True)
+    np.testing.assert_allclose(batch.widths[:2], [1.28e-4, 1.28e-4])
+    assert np.isnan(batch.widths[2])
+
+
+def test_widths_while_tracking():
+    full = BatchPeakFinder(ranges, [maximum] * 3)
+    tracked = BatchPeakFinder(ranges, [maximum] * 3)
+    tracked.track([1, 1, 1])
+    for y in drifting_traces(steps=20):
+        full(x, y, widths=True)
+        tracked(x, y, widths=True)
+        np.testing.assert_array_equal(tracked.widths, full.widths)
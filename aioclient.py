@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+In this module, an asyncio based counterpart to the Channel class in libclient
+is defined. It uses the same framing as libclient/libserver (2-byte protoheader,
+jsonheader, content), but runs on an asyncio event loop instead of a selector
+handled in a background thread. That way, a single event loop can drive many
+RedPitayas without a thread or a busy loop per device.
+"""
+import asyncio
+import itertools
+import struct
+import json
+
+import libclient
+
+
+class AsyncChannel(libclient.Message):
+    """
+    Persistent connection to the socket server on a RedPitaya. As with
+    libclient.Channel, many requests can be in flight at the same time. They
+    are matched to their responses using the request-id in the jsonheader.
+    The encoding and decoding of the messages is inherited from libclient.
+    Streamed results (see libclient.Channel) are passed to the sink of the
+    request.
+    """
+
+    def __init__(self, reader, writer, addr):
+        libclient.Message.__init__(self, None, None, addr, None, stop=True)
+        self.reader = reader
+        self.writer = writer
+        self.pending = dict()  # request-id -> asyncio.Future
+        self.sinks = dict()  # request-id -> callable for streamed results
+        self.closed = False
+        self._ids = itertools.count()
+        self._reader_task = asyncio.ensure_future(self._read_responses())
+
+    @classmethod
+    async def open(cls, addr, timeout=5):
+        """
+        Connect to addr (tuple of IP address and port) and return the channel.
+        """
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(addr[0], addr[1]), timeout
+        )
+        return cls(reader, writer, addr)
+
+    async def submit(self, request, sink=None):
+        """
+        Send a request (see RP_connection.create_request) and return the response.
+        If the action streams its result, sink is called with each streamed result.
+        Arrays in the response are writable, as with libclient.Channel.
+        """
+        if self.closed:
+            raise ConnectionError(f"Channel to {self.addr} is closed.")
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        if sink is not None:
+            self.sinks[request_id] = sink
+        header = {"request-id": request_id, "keep-alive": True}
+        try:
+            self.writer.write(self._create_request_message(request, header=header))
+            await self.writer.drain()
+        except BaseException:  # the request was not sent, so no response will come
+            self.pending.pop(request_id, None)
+            self.sinks.pop(request_id, None)
+            raise
+        return await future
+
+    async def _read_message(self):
+        hdrlen = struct.unpack(">H", await self.reader.readexactly(2))[0]
+        self.jsonheader = json.loads(await self.reader.readexactly(hdrlen))
+        data = await self.reader.readexactly(self.jsonheader["content-length"])
+        if self.jsonheader["content-type"] == libclient.NUMPY_CONTENT_TYPE:
+            # the arrays are views on the content, which would be read-only bytes
+            data = bytearray(data)
+        if self.jsonheader["content-type"] == "text/json":
+            return self._json_decode(data, self.jsonheader["content-encoding"])
+        elif self.jsonheader["content-type"] == libclient.NUMPY_CONTENT_TYPE:
+            return self._numpy_decode(data)
+        return data
+
+    async def _read_responses(self):
+        # runs as long as the connection is open and hands out the responses
+        try:
+            while True:
+                response = await self._read_message()
+                request_id = self.jsonheader.get("request-id")
+                if self.jsonheader.get("more", False):
+                    self._stream_result(request_id, response["result"])
+                    continue
+                future = self.pending.pop(request_id, None)
+                self.sinks.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass  # connection closed by the server or lost
+        finally:
+            self._fail_pending()
+
+    def _stream_result(self, request_id, result):
+        sink = self.sinks.get(request_id)
+        if sink is None:  # e.g. the sink failed before, discard the rest of the stream
+            return
+        try:
+            sink(result)
+        except Exception as exc:
+            self.sinks.pop(request_id, None)
+            future = self.pending.pop(request_id, None)
+            if future is not None and not future.done():
+                future.set_exception(exc)
+
+    def _fail_pending(self):
+        self.closed = True
+        self.sinks = dict()
+        pending, self.pending = self.pending, dict()
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(
+                    ConnectionError(f"Connection to {self.addr} closed.")
+                )
+
+    async def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+        self._reader_task.cancel()
+        try:
+            await self._reader_task
+        except asyncio.CancelledError:
+            pass
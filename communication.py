@@ -17,6 +17,8 @@ import selectors
 import traceback
 import libclient
 import threading
+import queue
+from concurrent.futures import Future
 
 # module for ssh communication
 import paramiko
@@ -55,6 +57,22 @@ for p in paths:
 DIR = Path(the_path, "settings")  # save the found pythonpath
 
 
+def completed_future(result):
+    # a future which already holds its result, e.g. if there is nothing to send.
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def gather(futures, timeout=None):
+    """
+    Waits for all futures (e.g. returned by send_async) and returns their
+    results in the same order. Since the requests are sent right away, their
+    round trips overlap.
+    """
+    return [future.result(timeout=timeout) for future in futures]
+
+
 class Sender:
     """
     This class is the framework used to establish the communication
@@ -78,6 +96,13 @@ class Sender:
         self.state = 0
         self.running = False
         self.DIR = DIR
+        # socket pair used to wake up the event_loop whenever sockets are
+        # (re)registered from other threads or the event loop is stopped.
+        # This way, the event_loop can block in select instead of polling.
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self.sel.register(self._wake_r, selectors.EVENT_READ, data=None)
 
     def event_loop(self):
         """
@@ -95,47 +120,39 @@ class Sender:
         self.running = True  # set the running variable to True
         # self.sel = selectors.DefaultSelector()
         try:
-            pass
-            while True:
-                if (
-                    not self.sel.get_map()
-                ):  # check whether there is something registered on the selector!
-                    sleep(0)
-                    pass
-                else:
-                    events = self.sel.select(
-                        timeout=1
-                    )  # select returns list of tuples, each for a socket.
-                    for (
-                        key,
-                        mask,
-                    ) in (
-                        events
-                    ):  # each tuple contains key and mask --> selectorkey | eventmask --> this iterates through each socket connection!
-                        message = key.data  # retrieve message
-                        if key.data != None:
-                            try:
-                                # this is for quicker data acquisition if multiple traces are subsequently captured
-                                if (
-                                    self.mode == "monitor"
-                                ):  # increase size if more data needs to be transferred at a time
-                                    message.buffersize = int(2**18)
-                                else:
-                                    message.buffersize = int(2**12)
-                                message.process_events(
-                                    mask
-                                )  # Process the event according to the mask! --> read or write.
-                            except Exception:
-                                print(
-                                    f"Main: Error: Exception for {message.addr}:\n"
-                                    f"{traceback.format_exc()}"
-                                )
-                                message.close()  # if exception, close the messsage
-                    # Check whether the event_loop should keep running:
-                    if (
-                        not self.running
-                    ):  # if running is set to False using stop_event_loop, the event_loop stops.
-                        break
+            while self.running:
+                # block until a socket is ready. Registering new sockets or
+                # stopping the loop wakes it up (see wakeup).
+                events = self.sel.select(
+                    timeout=None
+                )  # select returns list of tuples, each for a socket.
+                for (
+                    key,
+                    mask,
+                ) in (
+                    events
+                ):  # each tuple contains key and mask --> selectorkey | eventmask --> this iterates through each socket connection!
+                    message = key.data  # retrieve message
+                    if key.fileobj is self._wake_r:
+                        self._clear_wakeup()
+                    elif key.data != None:
+                        try:
+                            # this is for quicker data acquisition if multiple traces are subsequently captured
+                            if (
+                                self.mode == "monitor"
+                            ):  # increase size if more data needs to be transferred at a time
+                                message.buffersize = int(2**18)
+                            else:
+                                message.buffersize = int(2**12)
+                            message.process_events(
+                                mask
+                            )  # Process the event according to the mask! --> read or write.
+                        except Exception:
+                            print(
+                                f"Main: Error: Exception for {message.addr}:\n"
+                                f"{traceback.format_exc()}"
+                            )
+                            message.close()  # if exception, close the messsage
 
         except KeyboardInterrupt:
             print("Caught keyboard interrupt, exiting")
@@ -143,6 +160,23 @@ class Sender:
         finally:
             return  # this is necessary for the thread to stop after stoppin the event_loop
 
+    def wakeup(self):
+        """
+        Interrupts the select call of the event_loop, such that sockets which
+        were registered or modified from another thread are taken into account.
+        """
+        try:
+            self._wake_w.send(b"\0")
+        except BlockingIOError:  # buffer full --> wakeup is pending anyway.
+            pass
+
+    def _clear_wakeup(self):
+        try:
+            while self._wake_r.recv(1024):
+                pass
+        except BlockingIOError:
+            pass
+
     def start_event_loop(self):
         """
         Start an event loop which handles all the communication between the PC
@@ -151,6 +185,7 @@ class Sender:
         A thread is used to run this in the background.
         """
         if not self.running:  # only if the event loop is not running already!
+            self.running = True  # already set here, such that messages can be sent right away
             self.el_thread = threading.Thread(
                 target=self.event_loop
             )  # use threading to run the event_loop in the background
@@ -165,15 +200,34 @@ class Sender:
         # stops the event_loop by setting running to False.
         # The event_loop is usually run in a background thread for this to work!
         self.running = False
+        self.wakeup()
 
 
 class RP_connection:
-    def __init__(self, addr, mode="scan"):
+    def __init__(self, addr, mode="scan", persistent=True):
         self.addr = addr  # tuple of IP address and port used for socket
         self.mode = mode  # defines whether RP scans cavity or not.
-        self.lsock = None  # socket for interaction during loop.
+        self.lsock = None  # connection (libclient.Channel) for interaction during loop.
         self.loop_running = False  # boolean, whether loop is running or not.
         self.connected = False
+        # if persistent, requests share one long-lived connection (channel)
+        # instead of opening a new socket for every request.
+        self.persistent = persistent
+        self.channel = None
+        self._channel_lock = threading.Lock()
+
+    def __getstate__(self):
+        # sockets and locks can not be passed on to other processes (e.g. monitors).
+        # The channel is reopened there on the first request.
+        state = self.__dict__.copy()
+        state["channel"] = None
+        state["lsock"] = None
+        del state["_channel_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._channel_lock = threading.Lock()
 
     def _check_ext_scan(func):
         """
@@ -306,72 +360,180 @@ class RP_connection:
         sock.setblocking(False)  # non-blocking mode
         return sock
 
+    @_check_ext_scan
+    def open_channel(self, Sender):
+        """
+        Returns the persistent connection to the redpitaya, which is registered
+        on the selector of Sender. If there is none yet, or the previous one was
+        closed (e.g. the redpitaya restarted its server), it is (re)connected.
+        """
+        with self._channel_lock:
+            channel = self.channel
+            if channel is None or channel.closed or channel.selector is not Sender.sel:
+                if channel is not None:
+                    channel.close()
+                sock = self.connect_socket(self.addr)
+                channel = libclient.Channel(Sender.sel, sock, self.addr)
+                Sender.sel.register(sock, selectors.EVENT_READ, data=channel)
+                Sender.wakeup()
+                self.channel = channel
+            return channel
+
+    @_check_ext_scan
+    def close_channel(self):
+        # close the persistent connection, e.g. after the server was stopped.
+        with self._channel_lock:
+            if self.channel is not None:
+                self.channel.close()
+                self.channel = None
+
+    def _result_future(self, future):
+        """
+        Returns a future which resolves to the result of the response in future.
+        As for send, a lost connection is reported and results in None.
+        """
+        result = Future()
+
+        def done(f):
+            try:
+                response = f.result()
+            except ConnectionError as exc:
+                print(f"Caught exception: {exc}")
+                result.set_result(None)
+            except Exception as exc:  # e.g. raised by the sink of a stream
+                result.set_exception(exc)
+            else:
+                result.set_result(response["result"])
+
+        future.add_done_callback(done)
+        return result
+
+    def _loop_stopped(self, future):
+        # called once the response to 'stop' arrived through the loop connection
+        self.loop_running = False
+        if self.lsock is not None:
+            self.lsock.close()
+
+    @_check_ext_scan
+    def send_async(
+        self, Sender, action, value="Hello World!", loop=False, sink=None
+    ):
+        """
+        Sends an action to the redpitaya without waiting for the response.
+        The request is handled by the event_loop of Sender, so that requests to
+        several redpitayas can be in flight at the same time.
+        For actions which stream their result (e.g. acquire_ch_stream), each
+        streamed item is passed to sink. This requires a persistent connection.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            resolves to whatever the remotely executed function returns.
+        """
+        if not Sender.running:  # check if event_loop is running!
+            print("Event_loop not running!")
+            return completed_future(None)
+        if sink is not None and not (loop or self.persistent):
+            raise ValueError("Streamed results require a persistent connection.")
+        request = self.create_request(
+            action, value
+        )  # this is used to work with the RealPython socket example
+        if loop:  # a loop is running, the loop connection on port 5065 is used.
+            if self.lsock is None:
+                print("No connection to the running loop!")
+                return completed_future(None)
+            response = self.lsock.submit(request, sink=sink)
+            if action == "stop":
+                response.add_done_callback(self._loop_stopped)
+        elif self.persistent:
+            try:
+                response = self.open_channel(Sender).submit(request, sink=sink)
+            except ConnectionError:  # channel closed in the meantime, reconnect once.
+                response = self.open_channel(Sender).submit(request, sink=sink)
+        else:  # one socket connection per request
+            sock = self.connect_socket(self.addr)
+            message = libclient.Message(Sender.sel, sock, self.addr, request)
+            Sender.sel.register(
+                sock, selectors.EVENT_READ | selectors.EVENT_WRITE, data=message
+            )
+            response = message.future
+        Sender.wakeup()  # the event_loop has to take the new request into account
+        return self._result_future(response)
+
+    @_check_ext_scan
+    def stream(self, Sender, action, value="Hello World!", loop=False):
+        """
+        Generator over the items streamed by action (e.g. acquire_ch_stream),
+        which are yielded as soon as they arrive.
+        """
+        items = queue.Queue()
+        end = object()  # put into the queue once the last response arrived
+        future = self.send_async(Sender, action, value=value, loop=loop, sink=items.put)
+        future.add_done_callback(lambda f: items.put(end))
+        while True:
+            item = items.get()
+            if item is end:
+                break
+            yield item
+
     @_check_ext_scan
     def send(
         self, Sender, action, value="Hello World!", loop_action=False, loop=False
     ):  # Sender contains the event_loop that handles the multiple communications
         # used to send commands (so-called actions) to the redpitaya. e.g. send("echo")
+        if not loop_action:  # just wait for the response
+            return self.send_async(Sender, action, value=value, loop=loop).result()
         if Sender.running:  # check if event_loop is running!
             request = self.create_request(
                 action, value
             )  # this is used to work with the RealPython socket example
             # establishes socket connection to host
-            if not loop:
-                sock = self.connect_socket(self.addr)
-                addr = self.addr
-                stop = True
-            else:
-                sock = self.lsock
-                addr = (self.addr[0], 5065)
-                stop = False
-                if action == "stop":
-                    stop = True
+            sock = self.connect_socket(self.addr)
 
             # define message and event for the selector
             event_state = (
                 selectors.EVENT_READ | selectors.EVENT_WRITE
             )  # either read or write
-            message = libclient.Message(Sender.sel, sock, addr, request, stop=stop)
+            message = libclient.Message(Sender.sel, sock, self.addr, request)
             # here, the socket connection is registered on the selector of the event_loop!
             Sender.sel.register(sock, event_state, data=message)
-            # Here, the function has to wait for  a response!
-            # In the Message class, when the connection is unregistered, the
-            # used method saves the selectorkey! this is the indication for a
-            # finished response! initially set to None.
-
-            if loop_action:
-                self.loop_running = True
-
-            while True:
-                sleep(0)
-                # the following is done whenever a loop is started remotely --> setup loop socket 'lsock'!
-                if loop_action and self.loop_running:
-                    if self.lsock == None:
-                        if Sender.sel.get_key(sock).events & selectors.EVENT_READ:
-                            # after a loop has been initiated, start a second socket connection on port 50
-                            laddr = (self.addr[0], 5065)
-                            sleep(2)
-                            self.lsock = self.connect_socket(
-                                laddr
-                            )  # the second socket connection has to be established!
-                            sleep(0.5)
-                            try:
-                                self.lsock.getpeername()
-                            except Exception as exp:
-                                print(f"Exception occured during connection: {exp}")
-                                self.loop_running = False
-                                return "Exception occured during connection..."
-                            print(f"connected to {self.lsock}")
-
-                if message.selkey != None:
-                    if self.loop_running and action == "stop":
-                        self.loop_running = False
-                    break  # break whenever message closes connection --> also when exception occurs during event_loop!
-
-            # retrieve the response!
-            result = message.response["result"]
-            if loop_action:
-                self.lsock = None
+            Sender.wakeup()
+
+            self.loop_running = True
+            # once the request is sent, the loop is started on the redpitaya.
+            # --> setup loop socket 'lsock'! The response only arrives when the loop is finished.
+            message.sent.wait()
+            if not message.future.done():
+                # after a loop has been initiated, start a second socket connection on port 5065
+                laddr = (self.addr[0], 5065)
+                sleep(2)
+                lsock = self.connect_socket(
+                    laddr
+                )  # the second socket connection has to be established!
+                sleep(0.5)
+                try:
+                    lsock.getpeername()
+                except Exception as exp:
+                    print(f"Exception occured during connection: {exp}")
+                    self.loop_running = False
+                    return "Exception occured during connection..."
+                # all requests during the loop share this connection
+                self.lsock = libclient.Channel(Sender.sel, lsock, laddr)
+                Sender.sel.register(lsock, selectors.EVENT_READ, data=self.lsock)
+                Sender.wakeup()
+                print(f"connected to {lsock}")
+
+            # wait for the response, which arrives after the loop has finished
+            # (or if an exception occured during event_loop).
+            try:
+                result = message.future.result()["result"]
+            except ConnectionError as exc:
+                print(f"Caught exception: {exc}")
+                result = None
+            self.loop_running = False
+            if self.lsock is not None:
+                self.lsock.close()
+            self.lsock = None
         else:  # if no event_loop is running, return None
             print("Event_loop not running!")
             result = None
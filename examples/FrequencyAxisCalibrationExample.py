@@ -66,6 +66,23 @@ Lock.update_setting('Lock1', 'Slave1', 'enabled', True)
 Lock.update_setting('Lock1', 'Slave1', 'range', [0.36, 1.7])
 Lock.update_setting('Lock1', 'Slave1', 'lockpoint', 1.04)
 
+# %% Map the cavity modes
+
+# =============================================================================
+# Instead of acquiring one peak per range, all resonances of a scan are found
+# on the RP in a single call. Each row of the returned array holds the position
+# (ms), the height (V) and the full width at half prominence (ms) of one peak.
+# The prominence (V) rejects noise. Of peaks closer than distance samples, only
+# the highest one is kept and its neighbours are dropped. This is handy to
+# choose the ranges above and is used below to record the position of every
+# mode along with the wavemeter readings. If no peak is found (e.g. the cavity
+# is not scanned), the array has no rows.
+# =============================================================================
+prominence  = 0.05
+distance    = 100
+peaks = Lock.find_peaks('Lock1', 0, prominence, distance)
+print(f"Found {len(peaks)} peaks at {peaks[:, 0]} ms.")
+
 # %% Toggle cavity lock on and off
 
 # =============================================================================
@@ -105,6 +122,8 @@ timestamps_min_voltage  = np.array([])
 frequencies_min_voltage = np.array([])
 timestamps_max_voltage  = np.array([])
 frequencies_max_voltage = np.array([])
+peaks_min_voltage       = []
+peaks_max_voltage       = []
 
 # =============================================================================
 # The function nmtoTHz converts a wavelength in nm into a frequency in THz.
@@ -164,6 +183,11 @@ try:
 # =============================================================================
         timestamps_min_voltage  = np.append(timestamps_min_voltage,  timestamp)
         frequencies_min_voltage = np.append(frequencies_min_voltage, frequency)
+        
+# =============================================================================
+# The positions of all cavity modes are recorded with a single call per sample.
+# =============================================================================
+        peaks_min_voltage.append(Lock.find_peaks('Lock1', 0, prominence, distance)[:, 0])
         number_of_benchmark_samples_1 += 1
         sleep(0.1)
         
@@ -192,6 +216,7 @@ try:
         print(f"Press Ctrl + C to continue. Frequency: {frequency:3.6f}, Timestamp: {timestamp}")
         timestamps_max_voltage  = np.append(timestamps_max_voltage,  timestamp)
         frequencies_max_voltage = np.append(frequencies_max_voltage, frequency)
+        peaks_max_voltage.append(Lock.find_peaks('Lock1', 0, prominence, distance)[:, 0])
         number_of_benchmark_samples_2 += 1
         sleep(0.1)
 except:
@@ -219,6 +244,13 @@ np.savetxt(run_dir + r'\timestamps_min_voltage.txt', np.array([dt.strftime('%Y-%
 np.savetxt(run_dir + r'\frequencies_max_voltage.txt', np.array([frequencies_max_voltage]), delimiter='\n')
 np.savetxt(run_dir + r'\timestamps_max_voltage.txt', np.array([dt.strftime('%Y-%m-%d %H:%M:%S') for dt in timestamps_max_voltage]), delimiter=',', fmt = "%s")
 
+# =============================================================================
+# The number of peaks may change between the samples, so the positions of the
+# modes are saved as one array per sample.
+# =============================================================================
+np.savez(run_dir + r'\peaks_min_voltage.npz', *peaks_min_voltage)
+np.savez(run_dir + r'\peaks_max_voltage.npz', *peaks_max_voltage)
+
 # =============================================================================
 # We usually save the error array in a folder one level above the folder of an
 # individual measurment run. The reason for this is that the error acquisition
@@ -22,6 +22,11 @@ Initialize all of the RedPitayas using the RP_client class as follows:
         'monitor': This redpitaya is used for monitoring of the STCL
         'lock': This redpitaya is used for locking lasers.
 
+    Optionally, persistent = False can be passed to open a new socket connection
+    for every command (as in earlier versions). By default, all commands to a
+    redpitaya share one long-lived connection, which is reopened automatically
+    if it was lost.
+
 Those objects should be stored in a dictionary for the initialization of the LockClient object.
 The keys are used to reference the specific redpitaya during the use of the STCL!
 example:
@@ -5,7 +5,8 @@ Created on Fri Jul 15 10:42:04 2022
 @author: epultinevicius
 """
 import numpy as np
-from math import factorial, log2
+from math import log2
+from RP_side.peak_finders import SG_array  # cached kernels, shared with the peak finders
 
 def duration(dec):
     return 2**14 * 8e-9 * dec # trace duration in s
@@ -68,18 +69,6 @@ def check_PID(PID_dict):
         else:
             return True
 
-def SG_array(window_size = 21, order = 2, deriv=0, rate=1): # based on https://scipy-cookbook.readthedocs.io/items/SavitzkyGolay.html
-    """
-    calculates an array which is used for convolution in an savitky-golay filter
-    with a window_size, order to smoothen the deriv-th derivative of some data.
-    """
-    # precompute coefficients
-    half_window = (window_size -1) // 2
-    order_range = range(order+1)
-    b = np.mat([[k**i for i in order_range] for k in range(-half_window, half_window+1)])
-    m = np.linalg.pinv(b).A[deriv] * rate**deriv * factorial(deriv)
-    return m
-
 window_size = 21
 order = 1
 order_range = range(order+1)
@@ -3,6 +3,16 @@ import selectors
 import json
 import io
 import struct
+import threading
+import itertools
+from concurrent.futures import Future
+
+import numpy as np
+
+# content-type for raw numpy buffers. It is announced in the 'accept' header of
+# every request, such that the server can send arrays without converting them
+# to json lists.
+NUMPY_CONTENT_TYPE = "application/x-numpy"
 
 
 class Message:
@@ -12,7 +22,9 @@ class Message:
         self.sock = sock
         self.addr = addr
         self.request = request
-        self._recv_buffer = b""
+        self._recv_buffer = bytearray()  # protoheader and jsonheader
+        self._content = None  # preallocated memoryview for the content, see _init_content
+        self._content_pos = 0  # number of content bytes received so far
         self._send_buffer = b""
         self._request_queued = False
         self._jsonheader_len = None
@@ -20,6 +32,8 @@ class Message:
         self.response = None
         self.buffersize = int(2**14)
         self.stop = stop        
+        self.future = Future()  # resolves to the response once the message is closed
+        self.sent = threading.Event()  # set once the request is completely sent
 
     def _set_selector_events_mask(self, mode):
         """Set selector to listen for events: mode is 'r', 'w', or 'rw'."""
@@ -36,16 +50,40 @@ class Message:
     def _read(self):
         try:
             # Should be ready to read
-            data = self.sock.recv(self.buffersize)
+            self._recv()
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
             pass
+
+    def _recv(self):
+        # Once the content-length is known, the content is received in place
+        # into the preallocated buffer, otherwise into the header buffer.
+        # Returns the number of bytes received (0 if the peer closed).
+        if self._content is not None:
+            nbytes = self.sock.recv_into(self._content[self._content_pos :])
+            self._content_pos += nbytes
         else:
-            if data:
-                self._recv_buffer += data
-            else:
-                # raise RuntimeError("Peer closed.")
-                pass
+            data = self.sock.recv(self.buffersize)
+            self._recv_buffer += data
+            nbytes = len(data)
+        return nbytes
+
+    def _init_content(self):
+        # allocate the buffer for the content and move bytes which were
+        # already received along with the jsonheader
+        content_len = self.jsonheader["content-length"]
+        self._content = memoryview(bytearray(content_len))
+        n = min(content_len, len(self._recv_buffer))
+        self._content[:n] = self._recv_buffer[:n]
+        del self._recv_buffer[:n]
+        self._content_pos = n
+
+    def _take_content(self):
+        # returns the content once it is complete, otherwise None
+        if self._content is None or self._content_pos < len(self._content):
+            return None
+        data, self._content = self._content.obj, None
+        return data
 
     def _write(self):
         if self._send_buffer:
@@ -71,19 +109,41 @@ class Message:
         return obj
 
     def _create_message(
-        self, *, content_bytes, content_type, content_encoding
+        self, *, content_bytes, content_type, content_encoding, header=None
     ):
         jsonheader = {
             "byteorder": sys.byteorder,
             "content-type": content_type,
             "content-encoding": content_encoding,
             "content-length": len(content_bytes),
+            "accept": NUMPY_CONTENT_TYPE,
         }
+        if header:
+            jsonheader.update(header)
         jsonheader_bytes = self._json_encode(jsonheader, "utf-8")
         message_hdr = struct.pack(">H", len(jsonheader_bytes))
         message = message_hdr + jsonheader_bytes + content_bytes
         return message
 
+    def _numpy_decode(self, data):
+        # rebuild the arrays as views on the received buffer (no copy)
+        arrays = []
+        for offset, dtype, shape in self.jsonheader["numpy-arrays"]:
+            count = int(np.prod(shape))
+            arr = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+            arrays.append(arr.reshape(shape))
+        return self._insert_arrays(self.jsonheader["numpy-skeleton"], arrays)
+
+    def _insert_arrays(self, obj, arrays):
+        # counterpart to the server side: replace the placeholders by the arrays
+        if isinstance(obj, dict):
+            if "__ndarray__" in obj:
+                return arrays[obj["__ndarray__"]]
+            return {key: self._insert_arrays(val, arrays) for key, val in obj.items()}
+        elif isinstance(obj, list):
+            return [self._insert_arrays(val, arrays) for val in obj]
+        return obj
+
     def _process_response_json_content(self):
         content = self.response
         #result = content.get("result")
@@ -125,6 +185,7 @@ class Message:
 
                 # Set selector to listen for read events, we're done writing.
                 self._set_selector_events_mask("r")
+                self.sent.set()
 
     def close(self):
         #print(f"Closing connection to {self.addr}")
@@ -146,10 +207,24 @@ class Message:
                 # Delete reference to socket object for garbage collection
                 self.sock = None
 
+        self.sent.set()  # nothing more will be sent, do not keep anyone waiting
+        if not self.future.done():
+            if self.response is None:  # closed due to an error
+                self.future.set_exception(
+                    ConnectionError(f"Connection to {self.addr} closed without response.")
+                )
+            else:
+                self.future.set_result(self.response)
+
     def queue_request(self):
-        content = self.request["content"]
-        content_type = self.request["type"]
-        content_encoding = self.request["encoding"]
+        message = self._create_request_message(self.request)
+        self._send_buffer += message
+        self._request_queued = True
+
+    def _create_request_message(self, request, header=None):
+        content = request["content"]
+        content_type = request["type"]
+        content_encoding = request["encoding"]
         if content_type == "text/json":
             req = {
                 "content_bytes": self._json_encode(content, content_encoding),
@@ -162,9 +237,7 @@ class Message:
                 "content_type": content_type,
                 "content_encoding": content_encoding,
             }
-        message = self._create_message(**req)
-        self._send_buffer += message
-        self._request_queued = True
+        return self._create_message(header=header, **req)
 
     def process_protoheader(self):
         hdrlen = 2
@@ -172,7 +245,7 @@ class Message:
             self._jsonheader_len = struct.unpack(
                 ">H", self._recv_buffer[:hdrlen]
             )[0]
-            self._recv_buffer = self._recv_buffer[hdrlen:]
+            del self._recv_buffer[:hdrlen]
 
     def process_jsonheader(self):
         hdrlen = self._jsonheader_len
@@ -180,7 +253,7 @@ class Message:
             self.jsonheader = self._json_decode(
                 self._recv_buffer[:hdrlen], "utf-8"
             )
-            self._recv_buffer = self._recv_buffer[hdrlen:]
+            del self._recv_buffer[:hdrlen]
             for reqhdr in (
                 "byteorder",
                 "content-length",
@@ -189,13 +262,12 @@ class Message:
             ):
                 if reqhdr not in self.jsonheader:
                     raise ValueError(f"Missing required header '{reqhdr}'.")
+            self._init_content()
 
     def process_response(self):
-        content_len = self.jsonheader["content-length"]
-        if not len(self._recv_buffer) >= content_len:
+        data = self._take_content()
+        if data is None:
             return
-        data = self._recv_buffer[:content_len]
-        self._recv_buffer = self._recv_buffer[content_len:]
         if self.jsonheader["content-type"] == "text/json":
             encoding = self.jsonheader["content-encoding"]
             self.response = self._json_decode(data, encoding)
@@ -203,6 +275,8 @@ class Message:
                 len(self.response['result'])
                 #print(f"Received response {self.response!r} from {self.addr}")
             self._process_response_json_content()
+        elif self.jsonheader["content-type"] == NUMPY_CONTENT_TYPE:
+            self.response = self._numpy_decode(data)
         else:
             # Binary or unknown content-type
             self.response = data
@@ -214,4 +288,117 @@ class Message:
         # Close when response has been processed
         self.close()
 
-        
\ No newline at end of file
+        
+
+class Channel(Message):
+    """
+    A persistent connection which carries many requests. Each request gets a
+    request-id in its jsonheader, which the server echoes in the response.
+    Responses are matched to their requests by that id and delivered through
+    futures. Requests may be submitted from any thread, while reading and
+    writing is done by the event loop of the selector.
+    Actions may stream their result as several responses, which are marked by
+    'more' in the jsonheader. Their results are passed to the sink of the
+    request, while the last response resolves the future.
+    """
+
+    def __init__(self, selector, sock, addr):
+        Message.__init__(self, selector, sock, addr, None, stop=True)
+        self.pending = dict()  # request-id -> Future
+        self.sinks = dict()  # request-id -> callable for streamed results
+        self.closed = False
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def submit(self, request, sink=None):
+        """
+        Queue a request and return a Future for its response. If the action
+        streams its result, sink is called with each streamed result (from the
+        event loop thread).
+        """
+        future = Future()
+        with self._lock:
+            if self.closed:
+                raise ConnectionError(f"Channel to {self.addr} is closed.")
+            request_id = next(self._ids)
+            self.pending[request_id] = future
+            if sink is not None:
+                self.sinks[request_id] = sink
+            header = {"request-id": request_id, "keep-alive": True}
+            self._send_buffer += self._create_request_message(request, header=header)
+            self._set_selector_events_mask("rw")
+        return future
+
+    def _read(self):
+        try:
+            nbytes = self._recv()
+        except BlockingIOError:
+            pass
+        else:
+            if not nbytes:  # the server closed the connection
+                self.close()
+
+    def read(self):
+        self._read()
+        # several responses may have arrived at once
+        while not self.closed:
+            if self._jsonheader_len is None:
+                self.process_protoheader()
+            if self._jsonheader_len is not None and self.jsonheader is None:
+                self.process_jsonheader()
+            if self.jsonheader is None or not self.process_response():
+                break
+
+    def write(self):
+        with self._lock:
+            self._write()
+            if not self._send_buffer and not self.closed:
+                self._set_selector_events_mask("r")
+
+    def process_response(self):
+        data = self._take_content()
+        if data is None:
+            return False
+        if self.jsonheader["content-type"] == "text/json":
+            response = self._json_decode(data, self.jsonheader["content-encoding"])
+        elif self.jsonheader["content-type"] == NUMPY_CONTENT_TYPE:
+            response = self._numpy_decode(data)
+        else:
+            response = data
+        request_id = self.jsonheader.get("request-id")
+        more = self.jsonheader.get("more", False)
+        # get ready for the next response
+        self._jsonheader_len = None
+        self.jsonheader = None
+        if more:
+            self._stream_result(request_id, response["result"])
+            return True
+        future = self.pending.pop(request_id, None)
+        self.sinks.pop(request_id, None)
+        if future is not None:
+            future.set_result(response)
+        return True
+
+    def _stream_result(self, request_id, result):
+        sink = self.sinks.get(request_id)
+        if sink is None:  # e.g. the sink failed before, discard the rest of the stream
+            return
+        try:
+            sink(result)
+        except Exception as exc:
+            # the error is passed on to whoever waits for the request
+            self.sinks.pop(request_id, None)
+            future = self.pending.pop(request_id, None)
+            if future is not None:
+                future.set_exception(exc)
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            Message.close(self)
+            pending, self.pending = self.pending, dict()
+            self.sinks = dict()
+        for future in pending.values():  # requests without response will not get one anymore
+            future.set_exception(ConnectionError(f"Connection to {self.addr} closed."))
@@ -5,7 +5,8 @@ Created on Mon Feb 27 10:45:59 2023
 @author: epultinevicius
 """
 
-from communication import Sender, RP_connection, Path
+from communication import Sender, RP_connection, Path, gather, completed_future
+from aioclient import AsyncChannel
 import matplotlib
 
 matplotlib.use("Qt5Agg")  # for plotting in another process
@@ -15,12 +16,13 @@ import json
 from time import sleep, perf_counter
 from general import *
 import threading
+import asyncio
 import multiprocessing as mp
 import queue  # for exception handling using multiprocessing.Queue
 from copy import deepcopy
 import sys
 from scipy.constants import golden  # golden ratio
-from RP_side.peak_finders import peak_finders, SG_array, SG_filter
+from RP_side.peak_finders import peak_finders, SG_array, SG_filter, minmax_decimate
 
 window_size = 21
 order = 1
@@ -56,6 +58,29 @@ def init_mon_dict():
     return d
 
 
+class TraceBuffer:
+    """
+    Sink for streamed traces (see acquire_ch_n), which are written into a
+    preallocated array of n traces.
+    """
+
+    def __init__(self, n):
+        self.n = n
+        self.traces = None
+        self.count = 0
+
+    def __call__(self, trace):
+        if self.traces is None:  # the shape of the traces is known with the first one
+            self.traces = np.empty((self.n,) + trace.shape, dtype=trace.dtype)
+        self.traces[self.count] = trace
+        self.count += 1
+
+    def result(self):
+        if self.traces is None:
+            return np.array([])
+        return self.traces[: self.count]
+
+
 class LockClient(Sender):
     def __init__(self, redpitayas, FSR=906, DIR=None):
         """
@@ -138,11 +163,13 @@ class LockClient(Sender):
         for master_RP in self.masters:
             RPs = self.find_slave_RPs(master_RP)
             # the last entry in that list is the cavity scanning redpitaya, so it is closed last!
-            for RP in RPs:
-                if self.RPs[RP].loop_running:
-                    self.stop_loop(RP)
-        for RP in self.RPs:  # disconnect all the redpitayas
-            self.disconnect(RP)
+            # The loops on the other redpitayas are stopped simultaneously.
+            gather(
+                [self.send_async(RP, "stop") for RP in RPs[:-1] if self.RPs[RP].loop_running]
+            )
+            if self.RPs[master_RP].loop_running:
+                self.stop_loop(master_RP)
+        self.disconnect_all()  # disconnect all the redpitayas
         self.stop_event_loop()  # finally, stop the event loop which handles communication!
 
     ################### Finding stuff ######################################
@@ -531,15 +558,17 @@ class LockClient(Sender):
         RP : str
             Key of the RedPitaya in question.
         """
-        RP_ = self.RPs[RP]
-        # load the current settings from the json file!
+        settings = self._load_settings(RP)
+        # then send the settings to the redpiaya. Invalid ranges or lockpoints
+        # are rejected by the redpitaya with an error message.
+        return self.send(RP, "update_settings", value=settings)
+
+    def _load_settings(self, RP):
+        # load the current settings from the json file and set them up as
+        # required for the redpitaya.
         with open(Path(self.DIR, f"{RP}.json"), "r") as file:
-            settings = json.load(file)
-        RP_.settings = settings
-        # the following sets up the settings as required for the redpitaya
-        settings = self.retrieve_settings(RP)
-        # then send the settings to the redpiaya
-        self.send(RP, "update_settings", value=settings)
+            self.RPs[RP].settings = json.load(file)
+        return self.retrieve_settings(RP)
 
     @_check_update_setting
     @_apply_to_monitor
@@ -726,8 +755,18 @@ class LockClient(Sender):
         Set the dec setting for redpitayas associated with a specific master RP
         --> adjusts the scan frequency for a specific cavity!
         """
-        if not check_dec(dec):
+        RPs = self._rescale_dec(master_RP, dec)
+        if RPs is None:
             return
+        # ... and send the setting to all redpitayas at once!
+        gather([self.send_async(RP, "set_dec", value=dec) for RP in RPs])
+        sleep(0.5)  # wait a bit until the decimation on the redpitayas is set up!
+
+    def _rescale_dec(self, master_RP, dec):
+        # rescales and saves the settings of all redpitayas associated with
+        # master_RP for the new dec. Returns these redpitayas (None if dec is invalid).
+        if not check_dec(dec):
+            return None
         #  first, find the redpitayas associated with master_RP
         RPs = self.find_slave_RPs(master_RP)
         # then, get the recent dec setting and use it to rescale the relevant settings
@@ -738,9 +777,7 @@ class LockClient(Sender):
         self.RPs[master_RP].settings["Master"]["dec"] = dec
         for RP in RPs:
             self.save_settings(RP)  # finally save all the settings to the json files!
-            # ... and send the setting to the redpitayas!
-            self.send(RP, "set_dec", value=dec)
-        sleep(0.5)  # wait a bit until the decimation on the redpitayas is set up!
+        return RPs
 
     ################ Monitoring related functions ######################
     @_check_for_loop
@@ -806,6 +843,16 @@ class LockClient(Sender):
             if self.monitors[RP]["running"].value:
                 self.monitors[RP]["queue"].put(("filter", on))
 
+    def roi_monitor(self, RP, on=True, step=1):
+        """
+        Let the cavity monitor only acquire the regions of interest, i.e. the
+        ranges of the lock settings. For display, only every step-th point
+        of them is transferred (before the min/max decimation, if any).
+        """
+        if RP in self.monitors:
+            if self.monitors[RP]["running"].value:
+                self.monitors[RP]["queue"].put(("roi", on, step))
+
     def set_monitor_of_type(self, monitor_RP, Type="cavity"):
         master_RP = self.find_master_RP(monitor_RP)
         settings = self.retrieve_monitor_settings(master_RP)
@@ -876,6 +923,17 @@ class LockClient(Sender):
             - "SG_maximum" : finds max of raw data, then filters the signal around
                 the maximum using a savitzky-golay filter (0th order) and detects
                 the maximum again.
+            - "parabolic" : interpolates the maximum with a parabola through the
+                maximum and its two neighbours (sub-sample resolution)
+            - "gaussian" : as "parabolic", but on the logarithm of the data,
+                which is exact for gaussian peaks
+            - "centroid" : center of mass of the peak above a level. kwargs:
+                "level" (fraction of the peak height, default 0.5) and
+                "window_size" (samples around the maximum, default 21)
+            - "lorentzian" : least squares fit of a lorentzian to "window_size"
+                samples around the maximum (default 11)
+        The interpolating peakfinders keep a good resolution for few samples
+        per peak, i.e. at higher decimations.
         If SG-filter is involved, the following kwargs should be provided:
             - "window_size" : number of data points used for convolution of the signal.
                             Default: 21
@@ -950,8 +1008,9 @@ class LockClient(Sender):
     def acquire_ch_n(self, RP, ch, n):
         """
         collect data from a certain input (ch) on the redpitaya (RP) n times in sequence.
-        If n is larger than 100,the redpitaya CPU start having problems to save and transfer the data.
-        Thus, the acquisition is split into several sets of max. 100 traces. for n > 100.
+        The traces are streamed by the redpitaya one by one and written into a
+        preallocated array, so there is no limit on n. Without a persistent
+        connection, the acquisition is split into several sets of max. 100 traces.
 
         Parameters
         ----------
@@ -968,6 +1027,12 @@ class LockClient(Sender):
             data of all the collected traces, concatenated into a single array.
 
         """
+        if self.RPs[RP].persistent:
+            traces = TraceBuffer(n)
+            self.send_async(
+                RP, "acquire_ch_stream", value=f"{ch},{n}", sink=traces
+            ).result()
+            return traces.result()
         # acquire n traces on channel ch
         if n > 100:
             # if more than 100 traces, then split this task auch that the redpitaya only saves 100 traces at once!
@@ -986,6 +1051,144 @@ class LockClient(Sender):
             dat = self.send(RP, action, value=value)
         return dat
 
+    @_check_for_loop
+    @_check_cavity_scanned
+    def acquire_stats(self, RP, ch, n, ranges=[], bins=100, peak_finder="maximum"):
+        """
+        Acquire n traces on a certain input (ch) of the redpitaya (RP), but only
+        transfer their statistics, which are computed on the redpitaya.
+
+        Parameters
+        ----------
+        RP : str
+            Key of the respective redpitaya that is adressed.
+        ch : int
+            input channel of the redpitaya oscilloscope.
+        n : int
+            number of subsequent traces.
+        ranges : list, optional
+            index ranges [i0, i1] in which peaks are searched. The default is [].
+        bins : int, optional
+            number of bins of the peak position histograms. The default is 100.
+        peak_finder : str, optional
+            name of the peak finder (see peak_finders). The default is 'maximum'.
+
+        Returns
+        -------
+        dict
+            n, mean, var, min and max trace as well as 'peaks', a list with
+            dict(range, counts, edges) for each range.
+        """
+        query = dict(ch=ch, n=n, ranges=ranges, bins=bins, peak_finder=peak_finder)
+        return self.send(RP, "acquire_stats", value=query)
+
+    def find_peaks(self, RP, ch, prominence, distance=1):
+        """
+        Find all peaks in one trace on a certain input (ch) of the redpitaya
+        (RP), without giving ranges. This is done on the redpitaya in a single
+        pass, so the whole scan (e.g. all modes of the cavity) is mapped with
+        one call.
+
+        Parameters
+        ----------
+        RP : str
+            Key of the respective redpitaya that is adressed.
+        ch : int
+            input channel of the redpitaya oscilloscope.
+        prominence : float
+            minimum height of a peak above its surroundings (in V).
+        distance : int, optional
+            minimum distance of two peaks in samples. Peaks closer to a higher
+            peak are removed, starting from the highest one. The default is 1.
+
+        Returns
+        -------
+        array
+            one row [position (ms), height (V), full width at half prominence (ms)]
+            per peak, sorted by position. Without any peak (or if no trace
+            could be acquired), the array has the shape (0, 3).
+        """
+        peaks = self._find_peaks(RP, ch, prominence, distance)
+        if isinstance(peaks, str):  # error message of the redpitaya
+            print(peaks)
+            peaks = None
+        if peaks is None:
+            peaks = ()
+        return np.reshape(np.asarray(peaks, dtype=float), (-1, 3))
+
+    @_check_for_loop
+    @_check_cavity_scanned
+    def _find_peaks(self, RP, ch, prominence, distance):
+        query = dict(ch=ch, prominence=prominence, distance=distance)
+        return self.send(RP, "find_peaks", value=query)
+
+    def get_latency(self, RP, reset=False):
+        """
+        Timing of the recent locking steps on the redpitaya RP: for each phase
+        (trigger, readout, peaks, errors, pid, output) and the total, the
+        median (p50), 99th percentile (p99) and maximum duration in us.
+        Works while the lock is running as well as afterwards.
+
+        Parameters
+        ----------
+        RP : str
+            Key of the respective redpitaya that is adressed.
+        reset : bool, optional
+            clear the recorded timings afterwards. The default is False.
+
+        Returns
+        -------
+        dict
+            phase -> dict(p50, p99, max), and n, the number of recorded steps.
+        """
+        return self.send(RP, "latency", value="reset" if reset else "")
+
+    @_check_for_loop
+    def set_pipeline(self, RP, on=True):
+        """
+        Enable or disable pipelined scans for the next cavity lock on the
+        redpitaya RP: the next scan is started right after the readout of the
+        current one and captured while it is processed. The Master offset is
+        then applied one scan later, so the PID gains may need to be retuned.
+        Disabled by default.
+        """
+        return self.send(RP, "pipeline", value=on)
+
+    def set_tracking(self, RP, width=16):
+        """
+        Set the half width (in samples) of the windows around the last peak
+        positions, in which the peaks are searched during the lock on the
+        redpitaya RP. A range is only searched completely if its peak gets
+        lost. Use 0 to always search the whole ranges again. The default is 16.
+        Tracking is disabled until it is enabled with this function.
+        """
+        return self.send(RP, "tracking", value=width)
+
+    def get_telemetry(self, RP):
+        """
+        Telemetry of the lock loop running on the redpitaya RP since the last
+        call: achieved iteration rate (Hz), number of iterations and skipped
+        points, histogram of the intervals between iterations as a list of
+        [from (us), to (us), count], mean, std, p50, p99 and max of the
+        intervals (us) as 'interval' (the jitter of the loop), saturated PID
+        updates per laser and the mean linewidth (FWHM in ms) of the lockpoint
+        peak of each laser.
+        Cheap enough to be polled at ~10 Hz.
+        """
+        if not self.RPs[RP].loop_running:
+            print(f"No loop running on {RP}!")
+            return None
+        return self.send(RP, "telemetry")
+
+    @_check_for_loop
+    @_check_cavity_scanned
+    def iter_ch_n(self, RP, ch, n):
+        """
+        Same as acquire_ch_n, but returns a generator which yields the traces
+        as soon as they arrive. Requires a persistent connection.
+        """
+        return self.RPs[RP].stream(self, "acquire_ch_stream", value=f"{ch},{n}")
+
     ############## communication stuff ###########################
 
     def send(self, RP, action, value="Hello world!", loop_action=False):
@@ -1026,6 +1229,42 @@ class LockClient(Sender):
             print(f"{RP} not found.")
             return None
 
+    def send_async(self, RP, action, value="Hello world!", sink=None):
+        """
+        Same as send, but returns without waiting for the response. This way,
+        requests to several redpitayas are processed simultaneously. Use
+        communication.gather to wait for a list of these requests.
+        Items streamed by the action are passed to sink (see RP_connection.send_async).
+
+        Parameters
+        ----------
+        RP : str
+            Key in self.RPs for the respective redpitaya.
+        action : str
+            defines the action to be carried out on the redpitaya.
+        value : str, optional
+            defines a value that is queried in combination with the action.
+            The default is 'Hello world!'.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            resolves to the response from the redpitaya.
+
+        """
+        if RP in self.RPs:
+            if (
+                self.RPs[RP].mode == "ext_scan"
+            ):  # if external scan, no connection exists!
+                return completed_future(None)
+            loop = self.RPs[RP].loop_running
+            return self.RPs[RP].send_async(
+                self, action, value=value, loop=loop, sink=sink
+            )
+        else:
+            print(f"{RP} not found.")
+            return completed_future(None)
+
     def connect(self, RP):
         """
         star the host server on an individual redpitaya. This is mandatory in order
@@ -1056,12 +1295,15 @@ class LockClient(Sender):
         reduce waiting time.
         """
         print("connecting...")
+        threads = []
         for RP in self.RPs:
             t = threading.Thread(
                 target=self.RPs[RP].start_host_server, daemon=True
             )  # collect all connection functions in threads
             t.start()
-            t.join()  # join the thread such that the main program waits for all redpitayas to connect!
+            threads.append(t)
+        for t in threads:
+            t.join()  # join the threads such that the main program waits for all redpitayas to connect!
         sleep(
             5
         )  # sleep for 5 seconds while each redpitaya loads the respective libraries.
@@ -1079,10 +1321,132 @@ class LockClient(Sender):
         # closes the ssh connection
         if self.RPs[RP].connected:
             self.send(RP, "stop")
+            self.RPs[RP].close_channel()
             self.RPs[RP].connected = False
         else:
             print(f"{RP} not connected.")
 
+    def disconnect_all(self):
+        """
+        Closes the listening servers on all connected redpitayas simultaneously.
+        """
+        RPs = [RP for RP in self.RPs if self.RPs[RP].connected]
+        gather([self.send_async(RP, "stop") for RP in RPs])
+        for RP in RPs:
+            self.RPs[RP].close_channel()
+            self.RPs[RP].connected = False
+
+
+class AsyncLockClient(LockClient):
+    """
+    LockClient with coroutine versions of the communication related methods
+    (asend, aacquire, aacquire_ch_n, aupdate_settings and aset_dec). A
+    persistent asyncio connection is kept per redpitaya, such that a single
+    asyncio event loop drives all of them, e.g.
+
+        results = await asyncio.gather(*(client.aacquire(RP) for RP in RPs))
+
+    While a loop is running on a redpitaya, the requests are passed to the loop
+    connection of the (threaded) LockClient, which has to be started for that.
+    """
+
+    def __init__(self, redpitayas, FSR=906, DIR=None):
+        LockClient.__init__(self, redpitayas, FSR=FSR, DIR=DIR)
+        self.channels = dict()  # RP -> aioclient.AsyncChannel
+        self._channel_locks = dict()
+
+    async def _achannel(self, RP):
+        # returns the open channel to RP, (re)connects if required
+        lock = self._channel_locks.setdefault(RP, asyncio.Lock())
+        async with lock:
+            channel = self.channels.get(RP)
+            if channel is None or channel.closed:
+                channel = await AsyncChannel.open(self.RPs[RP].addr)
+                self.channels[RP] = channel
+        return channel
+
+    async def aclose_channels(self):
+        """
+        Close the asyncio connections to all redpitayas.
+        """
+        channels, self.channels = self.channels, dict()
+        await asyncio.gather(*(channel.close() for channel in channels.values()))
+
+    async def asend(self, RP, action, value="Hello world!", sink=None):
+        """
+        Coroutine version of send. See LockClient.send for the parameters.
+        Items streamed by the action are passed to sink.
+        A lost connection is reported and results in None.
+        """
+        if RP not in self.RPs:
+            print(f"{RP} not found.")
+            return None
+        RP_ = self.RPs[RP]
+        if RP_.mode == "ext_scan":  # if external scan, no connection exists!
+            return None
+        if RP_.loop_running:
+            # the loop connection is owned by the event loop thread of the LockClient
+            return await asyncio.wrap_future(
+                self.send_async(RP, action, value=value, sink=sink)
+            )
+        request = RP_.create_request(action, value)
+        for attempt in range(2):
+            try:
+                channel = await self._achannel(RP)
+                response = await channel.submit(request, sink=sink)
+            except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+                if attempt:  # reconnecting once did not help
+                    print(f"Connection to {RP_.addr} failed: {e}")
+                    return None
+            else:
+                return response["result"]
+
+    def _acquisition_possible(self, RP):
+        # same checks as the _check_for_loop and _check_cavity_scanned decorators
+        if self.RPs[RP].loop_running:
+            print(f"Loop currently running on {RP}! Stop it before running this function!")
+            return False
+        return self.check_cavity_scanned(RP)
+
+    async def aacquire(self, RP):
+        """
+        Coroutine version of acquire.
+        """
+        if not self._acquisition_possible(RP):
+            return np.array([])
+        return np.array(await self.asend(RP, "acquire"))
+
+    async def aacquire_ch_n(self, RP, ch, n):
+        """
+        Coroutine version of acquire_ch_n. The streamed traces are written
+        into a preallocated array.
+        """
+        if not self._acquisition_possible(RP):
+            return np.array([])
+        traces = TraceBuffer(n)
+        await self.asend(RP, "acquire_ch_stream", value=f"{ch},{n}", sink=traces)
+        return traces.result()
+
+    async def aupdate_settings(self, RP):
+        """
+        Coroutine version of update_settings.
+        """
+        settings = self._load_settings(RP)
+        result = await self.asend(RP, "update_settings", value=settings)
+        self.set_monitor(RP)
+        return result
+
+    async def aset_dec(self, master_RP, dec):
+        """
+        Coroutine version of set_dec.
+        """
+        RPs = self._rescale_dec(master_RP, dec)
+        if RPs is None:
+            return
+        await asyncio.gather(*(self.asend(RP, "set_dec", value=dec) for RP in RPs))
+        await asyncio.sleep(0.5)  # wait until the decimation is set up!
+        self.set_monitor(master_RP)
+
 
 ######################## Monitoring Classes ###################################
 
@@ -1097,6 +1461,10 @@ class Monitor(Sender):
         self.settings = settings
         self.monitor_running = bool_var  # a shared boolean variable
         self.filter = False
+        self.roi = False  # only acquire the regions of interest (ranges of the settings)
+        self.roi_step = 1
+        self.windows = dict()  # range -> (x, y) of the last acquired regions of interest
+        self.display_bins = 1000  # min/max decimation before plotting, None to plot all points
 
     ################ Cavity monitoring related functions ######################
     def stop_monitor(self, event):
@@ -1123,6 +1491,8 @@ class Monitor(Sender):
                     self.update_settings(query[1])
                 if query[0] == "filter":  # toggle filter
                     self.toggle_filter(query[1])
+                if query[0] == "roi":  # toggle acquisition of the regions of interest
+                    self.toggle_roi(*query[1:])
             except queue.Empty:
                 pass  # if nothing is in the queue, just repeat the loop!
             self.update_monitor()
@@ -1132,16 +1502,65 @@ class Monitor(Sender):
         return  # return required for thread to close properly.
 
     def acquire(self):
-        a = self.RP.send(self, "acquire_ch", value="0")
-        dur, self.acquisition = a
-        self.times = np.linspace(0, dur, 2**14)  # in ms
+        ranges = self.roi_ranges()
+        if self.roi and ranges:
+            x, y = self.acquire_roi(ranges)
+        else:
+            a = self.RP.send(self, "acquire_ch", value="0")
+            dur, self.acquisition = a
+            self.times = np.linspace(0, dur, 2**14)  # in ms
+            x, y = self.times[1:], self.acquisition[1:]
+            self.windows = dict()
+            if self.display_bins:  # plotting more points than pixels is a waste of time
+                x, y = minmax_decimate(x, y, self.display_bins)
         # save data in dictionary
         self.data = dict(
-            Cavity=np.array([self.times[1:], self.acquisition[1:]]),
+            Cavity=np.array([x, y]),
         )
         if self.filter:
             self.filter_signals()
 
+    def roi_ranges(self):
+        # the index ranges of all enabled lasers are the regions of interest
+        ranges = []
+        for laser, val in self.settings.items():
+            if val["enabled"]:
+                if laser == "Master":
+                    ranges += [tuple(R) for R in val["range"]]
+                else:
+                    ranges.append(tuple(val["range"]))
+        return sorted(set(ranges))
+
+    def acquire_roi(self, ranges):
+        """
+        acquire only the data within ranges. The windows are saved in
+        self.windows and returned concatenated, separated by NaN (gaps in the plot).
+        Unless the signals are filtered, the windows are decimated on the redpitaya.
+        """
+        query = dict(ch=0, ranges=ranges, step=self.roi_step)
+        decimate = self.display_bins and not self.filter
+        if decimate:  # share the bins among the windows
+            query["bins"] = max(1, self.display_bins // len(ranges))
+        dur, windows = self.RP.send(self, "acquire_roi", value=query)
+        self.times = np.linspace(0, dur, 2**14)  # in ms
+        self.windows = dict()
+        xs, ys = [], []
+        for R, window in zip(ranges, windows):
+            if decimate:
+                j, y = window
+                x = self.times[R[0] + j * self.roi_step]
+            else:
+                y = window
+                x = self.times[R[0] : R[-1] : self.roi_step]
+            self.windows[R] = (x, y)
+            xs += [x, [np.nan]]
+            ys += [y, [np.nan]]
+        return np.concatenate(xs), np.concatenate(ys)
+
+    def toggle_roi(self, on=True, step=1):
+        self.roi = on
+        self.roi_step = step
+
     def toggle_filter(self, on=True):
         if on and not self.filter:
             self.filter = True
@@ -1153,16 +1572,25 @@ class Monitor(Sender):
 
     def filter_signals(self):
         for laser in self.settings:
-            kwargs = deepcopy(self.settings[laser]["peak_finder"])
+            kwargs = dict(self.settings[laser]["peak_finder"])
             name = kwargs.pop("name")
             if laser == "Master":
                 r = self.settings[laser]["range"][1]
             else:
                 r = self.settings[laser]["range"]
             if name[:2] == "SG":
-                m = SG_array(**kwargs)
-                x, y = self.times[1:], self.acquisition[1:]
-                self.data[laser + "filtered"] = SG_filter(x, y, r, m=m)
+                m = SG_array(**kwargs)  # cached, not recomputed for each frame
+                if not self.settings[laser]["enabled"]:
+                    # nothing is drawn, but the order of the lines is kept (see plot_lines)
+                    self.data[laser + "filtered"] = np.empty((2, 0))
+                elif not self.windows:  # the whole trace was acquired
+                    x, y = self.times[1:], self.acquisition[1:]
+                    self.data[laser + "filtered"] = SG_filter(x, y, r, m=m)
+                elif tuple(r) in self.windows:
+                    x, y = self.windows[tuple(r)]
+                    self.data[laser + "filtered"] = SG_filter(x, y, [0, len(y)], m=m)
+                else:  # the range was not acquired, do not draw an old trace
+                    self.data[laser + "filtered"] = np.empty((2, 0))
 
     def set_monitor_title(self):
         if type(self.settings["Master"]) == str:
@@ -1174,8 +1602,9 @@ class Monitor(Sender):
     def _decorate_figure(self):
         # an estimate for initial ylims based on the detected signal
         acq = self.data["Cavity"][1]
-        ymin = max(acq) - (max(acq) - min(acq)) * 1.2
-        ymax = max(acq) - min(acq) * 3 + min(acq)
+        acq_max, acq_min = np.nanmax(acq), np.nanmin(acq)  # NaN separates the regions of interest
+        ymin = acq_max - (acq_max - acq_min) * 1.2
+        ymax = acq_max - acq_min * 3 + acq_min
         self._ax.set_ylim(ymin, ymax)
         self._ax.set_xlabel("Time [ms]")
         self._ax.set_ylabel("Voltage [V]")
@@ -1488,7 +1917,7 @@ class ErrorMonitor(Sender):
 
 
 class RP_client(RP_connection):
-    def __init__(self, address, settings, mode="lock"):
-        RP_connection.__init__(self, address, mode=mode)
+    def __init__(self, address, settings, mode="lock", persistent=True):
+        RP_connection.__init__(self, address, mode=mode, persistent=persistent)
         self.settings = settings
         self.label = "Default"